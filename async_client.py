@@ -0,0 +1,304 @@
+# Programmatic asyncio client for the trading server.
+#
+# TradingClient keeps one connection open and lets any number of coroutines
+# send commands over it at the same time. Every request carries its own ID, and
+# a background task hands each response to the coroutine waiting for that ID,
+# so requests are pipelined instead of taking a round-trip each.
+#
+# If the connection drops, the client reconnects on the next request and logs
+# in again with the last credentials. Requests that were in flight fail with
+# ConnectionError instead of being resent, because the server may already have
+# executed them; only read-only commands are retried automatically. A
+# subscription is renewed after a reconnect, and its callback is given the
+# current balances again.
+#
+#     async with TradingClient() as client:
+#         await client.login("Root", "Root01")
+#         print(await client.balance())
+#         # Buy at the listed price, paying at most $500 a share
+#         await asyncio.gather(*(client.buy("MSFT", 1, 500, 2) for _ in range(100)))
+
+import asyncio
+import itertools
+import logging
+
+from client import DEFAULT_SERVER_HOST, DEFAULT_SERVER_PORT, TIMEOUT_SECONDS, response_status
+from protocol import encode_request, read_response_async
+
+# Seconds to wait before each reconnect attempt; the last value is repeated
+RECONNECT_DELAYS = (0.0, 0.1, 0.5, 1.0, 2.0)
+
+logger = logging.getLogger(__name__)
+
+
+class ServerError(Exception):
+    """
+    Raised when the server answers a command with a non-200 status.
+
+    The status is None for replies without one, such as the help text sent to
+    clients that are not logged in.
+    """
+
+    def __init__(self, status, response):
+        super().__init__(response)
+        self.status = status
+        self.response = response
+
+
+class TradingClient:
+    """
+    Asyncio client with concurrent in-flight requests and automatic reconnect.
+    """
+
+    def __init__(self, host=DEFAULT_SERVER_HOST, port=DEFAULT_SERVER_PORT, timeout=TIMEOUT_SECONDS,
+                 reconnect_attempts=len(RECONNECT_DELAYS)):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reconnect_attempts = reconnect_attempts
+        self._reader = None
+        self._writer = None
+        self._receiver = None
+        # Futures of the requests sent on the current connection, by request ID;
+        # replaced on every reconnect so a dead connection only fails its own requests
+        self._pending = {}
+        # Callbacks of the requests the server pushes further responses to, by request ID
+        self._push_handlers = {}
+        self._request_ids = itertools.count(1)
+        self._connect_lock = asyncio.Lock()
+        # Credentials and subscription callback replayed after a reconnect
+        self._credentials = None
+        self._on_update = None
+        self._closed = False
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self):
+        """
+        Open the connection unless it is already open, logging in again if needed.
+        """
+        async with self._connect_lock:
+            if self.connected:
+                return
+            self._closed = False
+            last_error = None
+            for attempt in range(max(1, self.reconnect_attempts)):
+                await asyncio.sleep(RECONNECT_DELAYS[min(attempt, len(RECONNECT_DELAYS) - 1)])
+                try:
+                    self._reader, self._writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.host, self.port), self.timeout)
+                    break
+                except (OSError, asyncio.TimeoutError) as e:
+                    last_error = e
+                    logger.warning(f"Connecting to {self.host}:{self.port} failed: {e}")
+            else:
+                raise ConnectionError(f"Could not connect to {self.host}:{self.port}: {last_error}")
+
+            self._pending = {}
+            self._push_handlers = {}
+            self._receiver = asyncio.create_task(self._receive_responses(self._reader, self._pending,
+                                                                         self._push_handlers))
+            if self._credentials is not None:
+                # Restore the session the previous connection was logged in with
+                response = await self._send(f"LOGIN {self._credentials[0]} {self._credentials[1]}")
+                if response_status(response) != 200:
+                    raise ServerError(response_status(response), response)
+            if self._on_update is not None:
+                # Renew the subscription; changes missed meanwhile are covered by the current balances
+                self._on_update(await self._send("SUBSCRIBE", self._on_update))
+
+    async def close(self):
+        """
+        Close the connection and fail any request still waiting for a response.
+        """
+        self._closed = True
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+        if self._receiver is not None:
+            await asyncio.gather(self._receiver, return_exceptions=True)
+        self._writer = self._reader = self._receiver = None
+
+    async def request(self, command, retry=False, on_push=None):
+        """
+        Send a command and return the server's response text.
+
+        Reconnects first if the connection was lost. With retry set, the command
+        is sent once more if the connection drops before its response arrives;
+        only use it for commands that are safe to run twice. on_push(text) is
+        called with every further response the server pushes for the command.
+        """
+        if self._closed:
+            raise ConnectionError("Client is closed.")
+        for attempt in range(2 if retry else 1):
+            if not self.connected:
+                await self.connect()
+            try:
+                return await self._send(command, on_push)
+            except ConnectionError:
+                if attempt or not retry:
+                    raise
+                logger.info(f"Connection lost, retrying {command.split()[0]}")
+
+    async def _send(self, command, on_push=None):
+        """
+        Send a command on the current connection and wait for its response.
+        """
+        request_id = next(self._request_ids)
+        if request_id > 0xFFFFFFFF:
+            # Request IDs are 32 bits on the wire; 0 is reserved for unparsable requests
+            self._request_ids = itertools.count(2)
+            request_id = 1
+        pending = self._pending
+        future = asyncio.get_running_loop().create_future()
+        pending[request_id] = future
+        if on_push is not None:
+            self._push_handlers[request_id] = on_push
+        try:
+            self._writer.write(encode_request(request_id, command))
+            await self._writer.drain()
+            return await asyncio.wait_for(future, self.timeout)
+        except OSError as e:
+            raise ConnectionError(f"Connection to server lost: {e}") from e
+        finally:
+            pending.pop(request_id, None)
+
+    async def _receive_responses(self, reader, pending, push_handlers):
+        """
+        Resolve the future of every response until the connection is closed.
+        """
+        error = ConnectionError("Server closed the connection.")
+        try:
+            while True:
+                request_id, response = await read_response_async(reader)
+                future = pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+                elif request_id in push_handlers:
+                    # A later response pushed for a request such as SUBSCRIBE
+                    push_handlers[request_id](response)
+                else:
+                    # A reply to a request that was never parsed, or one that timed out
+                    logger.warning(f"Unexpected response {request_id}: {response.strip()}")
+        except asyncio.IncompleteReadError:
+            pass
+        except OSError as e:
+            error = ConnectionError(f"Connection to server lost: {e}")
+        finally:
+            if self._writer is not None and self._reader is reader:
+                self._writer.close()
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+
+    async def _command(self, command, retry=False, empty_ok=False, on_push=None):
+        """
+        Send a command and return its response, raising ServerError unless it succeeded.
+
+        With empty_ok, the server's unnumbered "No records found" reply is
+        returned as a result instead of raised.
+        """
+        response = await self.request(command, retry, on_push)
+        status = response_status(response)
+        if status != 200 and not (empty_ok and status is None and response.startswith("No records found")):
+            raise ServerError(status, response)
+        return response
+
+    async def login(self, user_name, password):
+        """
+        Log in and remember the credentials for reconnects.
+        """
+        await self._command(f"LOGIN {user_name} {password}")
+        self._credentials = (user_name, password)
+
+    async def logout(self):
+        """
+        Log out; the server closes the connection afterwards.
+        """
+        self._credentials = None
+        return await self._command("LOGOUT")
+
+    async def buy(self, symbol, amount, price, user_id):
+        """
+        Buy amount shares of symbol at price for user_id.
+        """
+        return await self._command(f"BUY {symbol} {amount} {price} {user_id}")
+
+    async def sell(self, symbol, amount, price, user_id):
+        """
+        Sell amount shares of symbol at price for user_id.
+        """
+        return await self._command(f"SELL {symbol} {amount} {price} {user_id}")
+
+    async def batch(self, user_id, legs):
+        """
+        Apply (side, symbol, amount, price) legs for user_id all at once or not at all.
+        """
+        orders = " ".join(f"{side} {symbol} {amount} {price}" for side, symbol, amount, price in legs)
+        return await self._command(f"BATCH {user_id} {orders}")
+
+    async def subscribe(self, on_update):
+        """
+        Subscribe to balance and holdings changes and return the current balances.
+
+        on_update(text) is called with every update pushed afterwards, one
+        'UPDATE <user_id> <USD|symbol> <balance>' line per changed balance.
+        """
+        response = await self._command("SUBSCRIBE", on_push=on_update)
+        self._on_update = on_update
+        return response
+
+    async def unsubscribe(self):
+        """
+        Stop the updates started by subscribe().
+        """
+        self._on_update = None
+        self._push_handlers.clear()
+        return await self._command("UNSUBSCRIBE")
+
+    async def deposit(self, amount):
+        """
+        Add amount USD to the logged in user's balance.
+        """
+        return await self._command(f"DEPOSIT {amount}")
+
+    async def list(self, limit=None, after=None):
+        """
+        List the logged in user's holdings (all holdings for root), optionally one page.
+        """
+        return await self._command(self._paged("LIST", limit, after), retry=True, empty_ok=True)
+
+    async def balance(self, limit=None, after=None):
+        """
+        Return the logged in user's balance (all balances for root), optionally one page.
+        """
+        return await self._command(self._paged("BALANCE", limit, after), retry=True, empty_ok=True)
+
+    async def lookup(self, name, limit=None, after=None):
+        """
+        Search the holdings for a stock symbol or name.
+        """
+        return await self._command(self._paged(f"LOOKUP {name}", limit, after), retry=True)
+
+    @staticmethod
+    def _paged(command, limit, after):
+        """
+        Append the optional paging arguments to a command.
+        """
+        if limit is not None:
+            command += f" {limit}"
+            if after is not None:
+                command += f" AFTER {after}"
+        return command
@@ -0,0 +1,235 @@
+# Import necessary libraries
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from connections import IDLE_NOTICE, REJECT_NOTICE
+from protocol import MAX_REQUEST_LINE, UNKNOWN_REQUEST_ID, decode_request, encode_response, iter_response_frames
+
+logger = logging.getLogger(__name__)
+
+
+async def write_frame(writer, frame, send_timeout):
+    """
+    Queue a frame on the transport. drain only waits once the transport buffer
+    is full, so pipelined requests are answered without a round-trip each.
+
+    Raises TimeoutError if the client does not read enough of the buffer within
+    send_timeout seconds.
+    """
+    writer.write(frame)
+    await asyncio.wait_for(writer.drain(), send_timeout)
+
+
+async def handle_connection(reader, writer, executor, run_command, register_client, cleanup_client, connections,
+                            stopping, limits, metrics):
+    """
+    Handle a single client connection on the event loop.
+
+    The connection's lock in `connections` is held while a command runs, so a
+    shutdown only closes the connection between commands.
+    """
+    loop = asyncio.get_running_loop()
+    client_address = writer.get_extra_info("peername")[:2]
+    if len(connections) >= limits.max_connections:
+        metrics.increment("connections_rejected")
+        writer.write(REJECT_NOTICE)
+        writer.close()
+        return
+    register_client(client_address)
+    lock = connections[writer] = asyncio.Lock()
+    # Bound the response data buffered for a client that reads slowly
+    writer.transport.set_write_buffer_limits(high=limits.max_output_buffer)
+    # Initialize the user_id as None to indicate that the client is not logged in
+    user_id = None
+
+    def send(frame):
+        # Called from the executor thread; waits until the frame is written, so a
+        # slow reader holds back a streamed response instead of buffering it
+        asyncio.run_coroutine_threadsafe(write_frame(writer, frame, limits.send_timeout), loop).result()
+
+    # Tasks writing the updates of this connection's subscription
+    pushes = set()
+
+    def open_sender(request_id):
+        # A subscriptions sender whose updates are written by a task on the loop
+        # instead of a thread, between commands so responses are not split
+        def start(subscription, on_closed):
+            ready = asyncio.Event()
+
+            async def push_updates():
+                try:
+                    while True:
+                        await ready.wait()
+                        ready.clear()
+                        text = subscription.take_update()
+                        if text is None:
+                            break
+                        if text:
+                            async with lock:
+                                for frame in iter_response_frames(request_id, text):
+                                    await write_frame(writer, frame, limits.send_timeout)
+                except asyncio.TimeoutError:
+                    # The subscriber stopped reading; drop it like any slow client
+                    metrics.increment("slow_clients_dropped")
+                    logger.warning("dropping slow subscriber client=%s:%s", client_address[0], client_address[1])
+                    writer.transport.abort()
+                except ConnectionError:
+                    pass
+                finally:
+                    on_closed(subscription)
+
+            def create_task():
+                task = loop.create_task(push_updates())
+                pushes.add(task)
+                task.add_done_callback(pushes.discard)
+
+            def wake():
+                try:
+                    loop.call_soon_threadsafe(ready.set)
+                except RuntimeError:
+                    pass  # The loop is closed, and the task with it
+
+            # Called from the executor thread running SUBSCRIBE
+            loop.call_soon_threadsafe(create_task)
+            return wake
+
+        return start
+
+    try:
+        while True:
+            try:
+                line = await asyncio.wait_for(reader.readline(), limits.idle_timeout)
+            except asyncio.TimeoutError:
+                if pushes:
+                    continue  # A subscriber may only listen, so it is never reaped for being idle
+                # Reap the idle client
+                metrics.increment("connections_reaped")
+                writer.write(IDLE_NOTICE)
+                break
+            except ValueError:
+                # The line exceeded the stream limit, so the rest cannot be framed any more
+                writer.write(encode_response(UNKNOWN_REQUEST_ID, "400 request too long"))
+                break
+            if not line:
+                break
+            if not line.strip():
+                continue  # Ignore blank lines
+
+            async with lock:
+                if stopping.is_set():
+                    break  # The server is draining; do not start new commands
+
+                # Split the received line into request ID, command and arguments
+                try:
+                    request_id, command_parts = decode_request(line)
+                except ValueError:
+                    writer.write(encode_response(UNKNOWN_REQUEST_ID, "403 message format error"))
+                    continue
+
+                # Blocking SQLite work is handed to the bounded executor, which passes
+                # the response frames back to the event loop to be written
+                try:
+                    user_id, close_connection = await loop.run_in_executor(
+                        executor, run_command, request_id, command_parts, user_id, client_address, send, open_sender)
+                except TimeoutError:
+                    # The client stopped reading its response; discard what is queued for it
+                    metrics.increment("slow_clients_dropped")
+                    logger.warning("dropping slow client=%s:%s", client_address[0], client_address[1])
+                    writer.transport.abort()
+                    break
+                if close_connection:
+                    break
+
+    except (ConnectionError, asyncio.IncompleteReadError) as e:
+        logger.warning("connection error client=%s:%s error=%s", client_address[0], client_address[1], e)
+
+    finally:
+        connections.pop(writer, None)
+        # Forget the session if the client went away while logged in
+        cleanup_client(client_address)
+        writer.close()
+        for task in list(pushes):
+            task.cancel()
+
+
+async def drain(connections, deadline, notice):
+    """
+    Close every connection once its current command has finished, waiting
+    until the loop.time() deadline at the latest.
+    """
+    loop = asyncio.get_running_loop()
+    for writer, lock in list(connections.items()):
+        try:
+            await asyncio.wait_for(lock.acquire(), max(0.0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            logger.warning("Closing a connection with a command still running")
+            writer.close()
+            continue
+        try:
+            writer.write(notice)
+            await asyncio.wait_for(writer.drain(), max(0.1, deadline - loop.time()))
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+            lock.release()
+
+
+async def serve(host, port, run_command, register_client, cleanup_client, db_workers, stop_event, drain_timeout,
+                notice, limits, metrics, server_socket=None):
+    """
+    Accept clients on a single event loop until stop_event is set, then drain them.
+
+    Listens on server_socket if one is given, otherwise on host:port.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix="db")
+    # Open connections and the lock held while each one runs a command
+    connections = {}
+    stopping = asyncio.Event()
+
+    # Running handler tasks, awaited after the drain so they are not cancelled half way through their cleanup
+    handlers = set()
+
+    async def on_connect(reader, writer):
+        handlers.add(asyncio.current_task())
+        try:
+            await handle_connection(reader, writer, executor, run_command, register_client, cleanup_client,
+                                    connections, stopping, limits, metrics)
+        finally:
+            handlers.discard(asyncio.current_task())
+
+    # stop_event is set from other threads and signal handlers
+    threading.Thread(target=lambda: (stop_event.wait(), loop.call_soon_threadsafe(stopping.set)),
+                     name="async-stop", daemon=True).start()
+
+    if server_socket is not None:
+        server = await asyncio.start_server(on_connect, sock=server_socket, backlog=1024, limit=MAX_REQUEST_LINE)
+    else:
+        server = await asyncio.start_server(on_connect, host, port, backlog=1024, limit=MAX_REQUEST_LINE)
+    logger.info("Listening on %s:%s (asyncio)", *server.sockets[0].getsockname()[:2])
+    try:
+        await stopping.wait()
+        # Stop accepting, then let running commands finish
+        server.close()
+        deadline = loop.time() + drain_timeout
+        await drain(connections, deadline, notice)
+        if handlers:
+            await asyncio.wait(list(handlers), timeout=max(0.1, deadline - loop.time()))
+        await server.wait_closed()
+    finally:
+        executor.shutdown(wait=True)
+
+
+def run(host, port, run_command, register_client, cleanup_client, db_workers, stop_event, drain_timeout, notice,
+        limits, metrics, server_socket=None):
+    """
+    Run the asyncio server until stop_event is set or it is interrupted.
+    """
+    try:
+        asyncio.run(serve(host, port, run_command, register_client, cleanup_client, db_workers, stop_event,
+                          drain_timeout, notice, limits, metrics, server_socket))
+    except KeyboardInterrupt:
+        logger.info("Interrupted by user, initiating server shutdown.")
@@ -0,0 +1,340 @@
+# Load-generation and latency benchmark for the server.
+#
+# Starts server.py against a fresh database in a temporary directory, seeds it
+# with trader accounts and drives them concurrently over real sockets using the
+# wire protocol from protocol.py. Every trader logs in and then sends a random
+# mix of BUY/SELL/BATCH/LIST/BALANCE/DEPOSIT commands, and the time from sending a
+# request to receiving its complete response is recorded per command.
+#
+# The report shows the throughput and the p50/p99/p999 latencies per command.
+# Results can be saved as a JSON baseline and later runs compared against it:
+#
+#     python benchmark.py --traders 32 --duration 10 --save baseline.json
+#     python benchmark.py --traders 32 --duration 10 --compare baseline.json -- --group-commit
+#
+# Everything after "--" is passed to server.py unchanged.
+
+import argparse
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from ledger import take_snapshot
+from migrations import migrate
+from money import SHARE_SCALE, USD_SCALE
+from protocol import encode_request, read_response
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+# Default relative weights of the commands sent after logging in
+DEFAULT_MIX = "BUY=30,SELL=20,LIST=10,BALANCE=30,DEPOSIT=10"
+
+# Symbols the traders buy and sell, each seeded with a large holding
+SYMBOLS = ("MSFT", "AAPL", "GOOG", "AMZN", "NVDA", "TSLA", "META", "INTC")
+
+# Limit prices that never reject an order, so trades execute at the listed prices
+BUY_LIMIT = 1e6
+SELL_LIMIT = 0.01
+
+# Legs of every BATCH order, half buys and half sells
+BATCH_LEGS = 10
+
+# Starting cash and shares per symbol of every trader, enough to never run out
+STARTING_BALANCE = 10 ** 9
+STARTING_SHARES = 10 ** 6
+
+# Seconds to wait for the server to start accepting connections
+STARTUP_TIMEOUT = 15.0
+
+# Percentiles shown in the report
+PERCENTILES = (("p50", 50.0), ("p99", 99.0), ("p999", 99.9))
+
+
+def parse_mix(text):
+    """
+    Parse a command mix such as 'BUY=3,BALANCE=1' into (commands, weights).
+    """
+    commands, weights = [], []
+    for item in text.split(","):
+        command, _, weight = item.partition("=")
+        command = command.strip().upper()
+        if command not in ("BUY", "SELL", "BATCH", "LIST", "BALANCE", "DEPOSIT"):
+            raise argparse.ArgumentTypeError(f"unsupported command in mix: {command}")
+        commands.append(command)
+        weights.append(float(weight) if weight else 1.0)
+    return commands, weights
+
+
+def seed_database(directory, traders):
+    """
+    Create database.db in directory with the given number of funded traders.
+
+    Returns the list of (user_id, user_name, password) tuples.
+    """
+    conn = sqlite3.connect(os.path.join(directory, "database.db"))
+    try:
+        migrate(conn)
+        accounts = []
+        with conn:
+            cursor = conn.cursor()
+            for index in range(traders):
+                user_name, password = f"trader{index}", f"pw{index}"
+                cursor.execute("INSERT INTO Users (first_name, last_name, user_name, password, usd_balance) "
+                               "VALUES (?, ?, ?, ?, ?)", ("Trader", str(index), user_name, password, STARTING_BALANCE * USD_SCALE))
+                user_id = cursor.lastrowid
+                cursor.executemany("INSERT INTO Stocks (stock_symbol, stock_name, stock_balance, user_id) "
+                                   "VALUES (?, '', ?, ?)", [(symbol, STARTING_SHARES * SHARE_SCALE, user_id) for symbol in SYMBOLS])
+                accounts.append((user_id, user_name, password))
+        # Start the ledger from the seeded balances
+        take_snapshot(conn)
+        return accounts
+    finally:
+        conn.close()
+
+
+def free_port(host):
+    """
+    Ask the OS for a port that is currently free.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind((host, 0))
+        return probe.getsockname()[1]
+
+
+def start_server(directory, host, port, server_args, log_file):
+    """
+    Start server.py in directory and wait until it accepts connections.
+    """
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT, "--host", host, "--port", str(port)] + server_args,
+                               cwd=directory, stdout=log_file, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with status {process.returncode}")
+        try:
+            socket.create_connection((host, port), timeout=1.0).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("server did not start accepting connections in time")
+
+
+def build_command(command, user_id, rng):
+    """
+    Return a random request of the given kind for the trader user_id.
+    """
+    if command == "BUY":
+        return f"BUY {rng.choice(SYMBOLS)} {rng.randint(1, 10)} {BUY_LIMIT} {user_id}"
+    if command == "SELL":
+        return f"SELL {rng.choice(SYMBOLS)} {rng.randint(1, 10)} {SELL_LIMIT} {user_id}"
+    if command == "BATCH":
+        legs = [f"BUY {rng.choice(SYMBOLS)} {rng.randint(1, 10)} {BUY_LIMIT}" if leg % 2 == 0 else
+                f"SELL {rng.choice(SYMBOLS)} {rng.randint(1, 10)} {SELL_LIMIT}" for leg in range(BATCH_LEGS)]
+        return f"BATCH {user_id} " + " ".join(legs)
+    if command == "DEPOSIT":
+        return f"DEPOSIT {rng.uniform(1, 100):.2f}"
+    return command
+
+
+class Trader(threading.Thread):
+    """
+    One simulated client sending requests one at a time over its own connection.
+    """
+
+    def __init__(self, host, port, account, commands, weights, stop_at, operations, seed, start_barrier):
+        super().__init__(daemon=True)
+        self.host = host
+        self.port = port
+        self.user_id, self.user_name, self.password = account
+        self.commands = commands
+        self.weights = weights
+        self.stop_at = stop_at
+        self.operations = operations
+        self.rng = random.Random(seed)
+        self.start_barrier = start_barrier
+        # Latencies in seconds and error counts, per command
+        self.latencies = {}
+        self.errors = {}
+        self.failure = None
+
+    def request(self, sock, reader, request_id, command):
+        """
+        Send one request, wait for its response and record the latency.
+        """
+        name = command.split(" ", 1)[0]
+        started = time.perf_counter()
+        sock.sendall(encode_request(request_id, command))
+        response = read_response(reader)
+        elapsed = time.perf_counter() - started
+        if response is None:
+            raise ConnectionError("server closed the connection")
+        self.latencies.setdefault(name, []).append(elapsed)
+        if not response[1].startswith("200"):
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def run(self):
+        try:
+            with socket.create_connection((self.host, self.port)) as sock:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with sock.makefile("rb") as reader:
+                    self.start_barrier.wait()
+                    self.request(sock, reader, 1, f"LOGIN {self.user_name} {self.password}")
+                    request_id = 2
+                    while request_id - 2 < self.operations and time.perf_counter() < self.stop_at:
+                        command = self.rng.choices(self.commands, self.weights)[0]
+                        self.request(sock, reader, request_id, build_command(command, self.user_id, self.rng))
+                        request_id += 1
+                    self.request(sock, reader, request_id, "QUIT")
+        except Exception as e:
+            self.failure = e
+
+
+def percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(traders, elapsed):
+    """
+    Merge the measurements of all traders into per-command statistics.
+    """
+    latencies, errors = {}, {}
+    for trader in traders:
+        for name, values in trader.latencies.items():
+            latencies.setdefault(name, []).extend(values)
+        for name, count in trader.errors.items():
+            errors[name] = errors.get(name, 0) + count
+
+    results = {}
+    for name, values in sorted(latencies.items()):
+        values.sort()
+        results[name] = {
+            "count": len(values),
+            "errors": errors.get(name, 0),
+            "ops_per_sec": len(values) / elapsed,
+        }
+        for label, percent in PERCENTILES:
+            results[name][f"{label}_ms"] = percentile(values, percent) * 1000
+    total = sum(result["count"] for result in results.values())
+    return {"elapsed": elapsed, "total_ops": total, "ops_per_sec": total / elapsed, "commands": results}
+
+
+def print_report(summary, baseline=None):
+    """
+    Print the per-command table, with the change against baseline if one is given.
+    """
+    columns = ["count", "errors", "ops_per_sec"] + [f"{label}_ms" for label, _ in PERCENTILES]
+    print(f"{'command':<10}" + "".join(f"{column:>14}" for column in columns))
+    for name, result in summary["commands"].items():
+        line = f"{name:<10}"
+        for column in columns:
+            value = result[column]
+            line += f"{value:>14}" if isinstance(value, int) else f"{value:>14.3f}"
+        print(line)
+        if baseline is not None and name in baseline["commands"]:
+            line = f"{'  vs base':<10}"
+            for column in columns:
+                old = baseline["commands"][name][column]
+                line += f"{(result[column] - old) / old * 100:>+13.1f}%" if old else f"{'-':>14}"
+            print(line)
+    print(f"total: {summary['total_ops']} operations in {summary['elapsed']:.2f}s, "
+          f"{summary['ops_per_sec']:.1f} ops/sec")
+    if baseline is not None:
+        change = (summary["ops_per_sec"] - baseline["ops_per_sec"]) / baseline["ops_per_sec"] * 100
+        print(f"baseline: {baseline['ops_per_sec']:.1f} ops/sec ({change:+.1f}%)")
+
+
+def main():
+    """
+    Parse the command line, run the benchmark and report the results.
+    """
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for the trading server",
+                                     epilog="Arguments after '--' are passed to server.py.")
+    parser.add_argument("--host", default="127.0.0.1", help="address the server listens on")
+    parser.add_argument("--port", type=int, default=0, help="port for the server (default: any free port)")
+    parser.add_argument("--traders", type=int, default=16, help="number of concurrent simulated traders")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to generate load for")
+    parser.add_argument("--operations", type=int, default=sys.maxsize,
+                        help="stop each trader after this many commands, even if time is left")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"weighted command mix (default: {DEFAULT_MIX})")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the command sequences")
+    parser.add_argument("--save", metavar="FILE", help="write the results to FILE as a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with a saved JSON baseline")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary database directory")
+    args, server_args = parser.parse_known_args()
+    if server_args[:1] == ["--"]:
+        server_args = server_args[1:]
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    directory = tempfile.mkdtemp(prefix="stock-benchmark-")
+    port = args.port or free_port(args.host)
+    accounts = seed_database(directory, args.traders)
+    commands, weights = args.mix
+
+    with open(os.path.join(directory, "server.log"), "w") as log_file:
+        server = start_server(directory, args.host, port, server_args, log_file)
+        try:
+            start_barrier = threading.Barrier(args.traders + 1)
+            stop_at = time.perf_counter() + args.duration + STARTUP_TIMEOUT
+            traders = [Trader(args.host, port, account, commands, weights, stop_at, args.operations,
+                              args.seed + index, start_barrier)
+                       for index, account in enumerate(accounts)]
+            for trader in traders:
+                trader.start()
+            start_barrier.wait()
+            started = time.perf_counter()
+            for trader in traders:
+                trader.stop_at = started + args.duration
+            for trader in traders:
+                trader.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            server.terminate()
+            server.wait()
+
+    failures = [trader.failure for trader in traders if trader.failure is not None]
+    for failure in failures[:5]:
+        print(f"trader failed: {failure!r}", file=sys.stderr)
+
+    summary = summarize(traders, elapsed)
+    summary["config"] = {
+        "traders": args.traders,
+        "duration": args.duration,
+        "mix": dict(zip(commands, weights)),
+        "server_args": server_args,
+    }
+    print_report(summary, baseline)
+
+    if args.save:
+        with open(args.save, "w") as save_file:
+            json.dump(summary, save_file, indent=2)
+        print(f"results saved to {args.save}")
+    if args.keep:
+        print(f"database and server log kept in {directory}")
+    else:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+# Read-through cache of per-user balances and holdings.
+#
+# A user's row in Users and their rows in Stocks only change when a trade or
+# deposit for that user commits, so BALANCE, LIST and the pre-trade checks can
+# serve them from memory. Entries are evicted least recently used first and
+# expire after a TTL. Handlers call invalidate() after every committed change.
+#
+# A load that started before an invalidation must not put its stale result
+# back into the cache. Every user maps to one of a fixed set of version
+# counters, and a loaded value is only stored if the user's counter did not
+# move while it was being loaded.
+
+import threading
+import time
+from collections import OrderedDict
+
+# Default number of entries kept in the cache
+DEFAULT_MAX_ENTRIES = 10000
+
+# Default number of seconds an entry stays valid
+DEFAULT_TTL = 5.0
+
+# Number of version counters users are spread over
+VERSION_STRIPES = 256
+
+# Kinds of cached values
+USER_ROW = "user"
+HOLDINGS = "holdings"
+
+
+class BalanceCache:
+    """
+    A bounded LRU cache of user rows and holdings with a TTL and hit/miss counters.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._versions = [0] * VERSION_STRIPES
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_user(self, user_id, load):
+        """
+        Return the cached Users row of user_id, calling load() to fetch it on a miss.
+        """
+        return self._get((USER_ROW, user_id), user_id, load)
+
+    def get_holdings(self, user_id, load):
+        """
+        Return the cached Stocks rows of user_id, calling load() to fetch them on a miss.
+        """
+        return self._get((HOLDINGS, user_id), user_id, load)
+
+    def peek_user(self, user_id):
+        """
+        Return the cached Users row of user_id, or None without loading it.
+
+        Peeks are not counted as hits or misses, so the hit rate only reflects
+        the reads that load on a miss.
+        """
+        return self._lookup((USER_ROW, user_id), count=False)
+
+    def peek_holdings(self, user_id):
+        """
+        Return the cached Stocks rows of user_id, or None without loading them.
+        """
+        return self._lookup((HOLDINGS, user_id), count=False)
+
+    def invalidate(self, user_id):
+        """
+        Drop everything cached for user_id after a change to it was committed.
+        """
+        with self._lock:
+            self._versions[user_id % VERSION_STRIPES] += 1
+            self._entries.pop((USER_ROW, user_id), None)
+            self._entries.pop((HOLDINGS, user_id), None)
+            self.invalidations += 1
+
+    def stats(self):
+        """
+        Return a snapshot of the cache counters.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+    def _lookup(self, key, count=True):
+        """
+        Return the fresh cached value for key or None, counting the hit or miss if count is set.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            if count:
+                self.misses += 1
+            return None
+
+    def _get(self, key, user_id, load):
+        """
+        Read-through lookup of key.
+        """
+        value = self._lookup(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            version = self._versions[user_id % VERSION_STRIPES]
+        value = load()
+        if value is None or self.max_entries <= 0:
+            return value
+
+        with self._lock:
+            # Skip the store if the user changed while we were loading
+            if self._versions[user_id % VERSION_STRIPES] == version:
+                self._entries[key] = (value, time.monotonic() + self.ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
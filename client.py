@@ -1,15 +1,25 @@
+import argparse
+import collections
+import json
 import socket
 import sys
 import logging
+import itertools
+import threading
+import time
+
+from protocol import UNKNOWN_REQUEST_ID, encode_request, read_response
 
 # Define default server address and port
 DEFAULT_SERVER_HOST = '127.0.0.1'
 DEFAULT_SERVER_PORT = 12345
-BUFFER_SIZE = 1024  # Size of the buffer used to receive data from the server
 TIMEOUT_SECONDS = 10.0  # Timeout duration for server response
 
-# Configure the logging
-logging.basicConfig(level=logging.INFO)
+# Default number of requests a batch connection keeps in flight
+DEFAULT_BATCH_WINDOW = 64
+
+# Commands that change the state of a connection, sent on every batch connection
+SESSION_COMMANDS = ("LOGIN", "LOGOUT", "QUIT")
 
 # Define the main function for the client program
 def main(server_host, server_port):
@@ -24,6 +34,11 @@ def main(server_host, server_port):
             logging.error(f"Failed to connect to server: {e}")
             sys.exit(1)
 
+        # Buffered reader for the length-prefixed responses
+        reader = client_socket.makefile('rb')
+        # Every request carries its own ID so responses can be matched to it
+        request_ids = itertools.count(1)
+
         while True:
             try:
                 # Prompt the user to enter a command
@@ -32,16 +47,17 @@ def main(server_host, server_port):
                     continue  # Skip empty input and prompt again
 
                 # Send the command to the server
-                client_socket.send(command.encode())
+                request_id = next(request_ids)
+                client_socket.sendall(encode_request(request_id, command))
                 logging.info(f"Sent: {command}")
 
                 # Special handling for the QUIT command
                 if command.upper() == "QUIT":
-                    handle_server_response(client_socket)
+                    handle_server_response(client_socket, reader, request_id)
                     break  # Exit the loop and close the client after handling response
 
                 # Handle general server response for other commands
-                handle_server_response(client_socket)
+                handle_server_response(client_socket, reader, request_id)
 
             except socket.timeout:
                 # Handle the case where the server doesn't respond within the timeout
@@ -60,28 +76,205 @@ def main(server_host, server_port):
                 break
 
 # Define a function to handle server responses
-def handle_server_response(client_socket):
+def handle_server_response(client_socket, reader, request_id):
     # Apply a timeout to the socket to wait for a response
     client_socket.settimeout(TIMEOUT_SECONDS)
     
     try:
-        # Receive the response from the server
-        response = client_socket.recv(BUFFER_SIZE).decode().strip()
-        if response == '':
-            # If the response is empty, it means the server closed the connection
-            raise socket.error("Server closed the connection.")
-        # Log the server's response
-        logging.info(f"Server response: {response}")
+        # Receive complete responses until the one for our request arrives
+        while True:
+            frame = read_response(reader)
+            if frame is None:
+                # If there is no frame, it means the server closed the connection
+                raise socket.error("Server closed the connection.")
+            response_id, response = frame
+            # Log the server's response
+            logging.info(f"Server response: {response.strip()}")
+            if response_id == request_id:
+                break
     finally:
         # Reset the socket timeout to None (blocking mode) after handling the response
         client_socket.settimeout(None)
 
 
+# Define a function to extract the status code of a response
+def response_status(response):
+    """
+    Return the numeric status a response starts with, or None if it has none
+    (as for the help text sent to clients that are not logged in).
+    """
+    status = response.split(None, 1)[0] if response.strip() else ""
+    return int(status) if status.isdigit() else None
+
+
+# A persistent connection used by the batch mode
+class BatchConnection:
+    """
+    A connection that pipelines requests and matches the responses in a background thread.
+
+    At most `window` requests are in flight at once. Every response is passed
+    to on_result together with the input line number and command it answers.
+    """
+
+    def __init__(self, server_host, server_port, window, on_result):
+        self.socket = socket.create_connection((server_host, server_port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.socket.makefile('rb')
+        self.on_result = on_result
+        self.request_ids = itertools.count(1)
+        # Requests sent but not answered yet, oldest first, as the server replies in order
+        self.pending = collections.deque()
+        # IDs of SUBSCRIBE requests, whose later responses are pushed updates
+        self.subscriptions = set()
+        self.window = threading.Semaphore(window)
+        self.error = None
+        self.receiver = threading.Thread(target=self.receive_responses, daemon=True)
+        self.receiver.start()
+
+    def send(self, line_number, command):
+        """
+        Send a command once there is room in the window, without waiting for its response.
+        """
+        self.window.acquire()
+        if self.error is not None:
+            self.window.release()
+            raise self.error
+        request_id = next(self.request_ids)
+        if command.split(maxsplit=1)[:1] == ["SUBSCRIBE"]:
+            self.subscriptions.add(request_id)
+        self.pending.append((request_id, line_number, command, time.perf_counter()))
+        self.socket.sendall(encode_request(request_id, command))
+
+    def receive_responses(self):
+        """
+        Read responses until the server closes the connection or stops answering.
+        """
+        try:
+            while True:
+                frame = read_response(self.reader)
+                if frame is None:
+                    break
+                response_id, response = frame
+                if response_id == UNKNOWN_REQUEST_ID:
+                    # Not an answer to any request, e.g. the server shutting down
+                    logging.warning(f"Server: {response.strip()}")
+                    continue
+                if response_id in self.subscriptions and (not self.pending or self.pending[0][0] != response_id):
+                    # An update pushed after the SUBSCRIBE response
+                    logging.info(f"Update: {response.strip()}")
+                    continue
+                request_id, line_number, command, sent_at = self.pending.popleft()
+                if response_id != request_id:
+                    raise socket.error(f"Expected response {request_id}, got {response_id}.")
+                self.on_result(line_number, command, response, time.perf_counter() - sent_at)
+                self.window.release()
+        except (OSError, IndexError) as e:
+            self.error = e if isinstance(e, OSError) else socket.error("Unexpected response from server.")
+        if self.pending and self.error is None:
+            self.error = socket.error("Server closed the connection.")
+        # Wake up a sender waiting for room in the window
+        self.window.release()
+
+    def close(self):
+        """
+        Wait for the remaining responses and close the connection.
+        """
+        try:
+            self.socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        self.receiver.join()
+        self.reader.close()
+        self.socket.close()
+
+
+# Define the batch mode
+def run_batch(server_host, server_port, commands, output, connections=1, window=DEFAULT_BATCH_WINDOW):
+    """
+    Send every command read from `commands` and write one JSON result per line to `output`.
+
+    The commands are spread round-robin over `connections` persistent connections
+    and pipelined up to `window` requests per connection. LOGIN, LOGOUT and QUIT
+    are sent on every connection, so each one runs as the same user; LOGOUT and
+    QUIT end the batch. Returns the number of commands answered with a non-200 status.
+    """
+    output_lock = threading.Lock()
+    failures = 0
+
+    def write_result(line_number, command, response, latency):
+        nonlocal failures
+        status = response_status(response)
+        with output_lock:
+            if status != 200:
+                failures += 1
+            output.write(json.dumps({"line": line_number, "command": command, "status": status,
+                                     "response": response, "latency_ms": round(latency * 1000, 3)}) + "\n")
+
+    pool = [BatchConnection(server_host, server_port, window, write_result) for _ in range(connections)]
+    started = time.perf_counter()
+    sent = 0
+    try:
+        for line_number, line in enumerate(commands, 1):
+            command = line.strip()
+            if not command or command.startswith("#"):
+                continue  # Skip blank lines and comments
+            name = command.split(None, 1)[0].upper()
+            if name in SESSION_COMMANDS:
+                for connection in pool:
+                    connection.send(line_number, command)
+                    sent += 1
+                if name != "LOGIN":
+                    break
+            else:
+                pool[sent % len(pool)].send(line_number, command)
+                sent += 1
+    finally:
+        for connection in pool:
+            connection.close()
+
+    elapsed = time.perf_counter() - started
+    errors = [connection.error for connection in pool if connection.error is not None]
+    for error in errors:
+        logging.error(f"Batch connection failed: {error}")
+    logging.info(f"Sent {sent} commands in {elapsed:.3f}s ({sent / elapsed if elapsed else 0:.1f}/s), "
+                 f"{failures} failed")
+    if errors:
+        raise errors[0]
+    return failures
+
+
 # Execute the program
 if __name__ == "__main__":
     # Retrieve server host and port from command line arguments
-    server_host = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SERVER_HOST
-    server_port = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_SERVER_PORT
-    
-    # Run the main function with the provided host and port
-    main(server_host, server_port)
+    parser = argparse.ArgumentParser(description="Stock trading client")
+    parser.add_argument("host", nargs="?", default=DEFAULT_SERVER_HOST, help="server address")
+    parser.add_argument("port", nargs="?", type=int, default=DEFAULT_SERVER_PORT, help="server port")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="send the commands in FILE ('-' for stdin) instead of prompting for them")
+    parser.add_argument("--output", metavar="FILE", help="write the batch results to FILE instead of stdout")
+    parser.add_argument("--connections", type=int, default=1, help="connections a batch is spread over")
+    parser.add_argument("--window", type=int, default=DEFAULT_BATCH_WINDOW,
+                        help="requests a batch connection keeps in flight")
+    args = parser.parse_args()
+
+    # Configure the logging
+    logging.basicConfig(level=logging.INFO)
+
+    if args.batch is None:
+        # Run the main function with the provided host and port
+        main(args.host, args.port)
+        sys.exit(0)
+
+    commands = sys.stdin if args.batch == "-" else open(args.batch)
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        failed = run_batch(args.host, args.port, commands, output, args.connections, args.window)
+    except (OSError, socket.error) as e:
+        logging.error(f"Batch failed: {e}")
+        sys.exit(2)
+    finally:
+        if commands is not sys.stdin:
+            commands.close()
+        if output is not sys.stdout:
+            output.close()
+    sys.exit(1 if failed else 0)
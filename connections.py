@@ -0,0 +1,184 @@
+# Registry of the client connections served by the threaded server.
+#
+# A handler holds its connection's lock while it runs a command, from reading
+# the request to sending the last frame of the response. The server can
+# therefore wait for a connection to be between commands, tell the client it is
+# going away and close the socket, without cutting a trade or a response in
+# half. This is how shutdown drains the open connections.
+#
+# ConnectionLimits bounds what a single client can hold on to: connections idle
+# for longer than idle_timeout are closed, a response that cannot be written
+# within send_timeout because the client stopped reading drops the client, and
+# new clients beyond max_connections are turned away right after accept().
+# At most max_output_buffer bytes of responses are queued for a client that is
+# slow to read, and a client dropped for being too slow is reset so whatever is
+# still queued for it is freed at once.
+
+import selectors
+import socket
+import struct
+import threading
+import time
+
+from protocol import UNKNOWN_REQUEST_ID, encode_response
+
+# Default seconds a client may stay connected without sending a request
+DEFAULT_IDLE_TIMEOUT = 300.0
+
+# Default seconds the server waits for a client to accept part of a response
+DEFAULT_SEND_TIMEOUT = 30.0
+
+# Default most clients connected at once
+DEFAULT_MAX_CONNECTIONS = 1000
+
+# Default bytes of response data buffered per connection
+DEFAULT_MAX_OUTPUT_BUFFER = 256 * 1024
+
+# Sent to a client before closing its idle connection
+IDLE_NOTICE = encode_response(UNKNOWN_REQUEST_ID, "408 Idle timeout, closing connection")
+
+# Sent to a client turned away because the server is full
+REJECT_NOTICE = encode_response(UNKNOWN_REQUEST_ID, "503 Too many connections")
+
+
+def send_within(client_socket, data, timeout):
+    """
+    Send all of data, waiting at most timeout seconds (None waits forever) for
+    the client to accept it.
+
+    Unlike settimeout() and sendall(), this leaves the socket's own timeout
+    alone, so it can be used from another thread while the connection's
+    handler is blocked reading. Raises TimeoutError if the client does not
+    accept the data in time.
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    view = memoryview(data)
+    with selectors.DefaultSelector() as selector:
+        selector.register(client_socket, selectors.EVENT_WRITE)
+        while view:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0 or not selector.select(remaining):
+                raise TimeoutError("the client did not accept the data in time")
+            try:
+                view = view[client_socket.send(view, socket.MSG_DONTWAIT):]
+            except BlockingIOError:
+                pass
+
+
+class ConnectionLimits:
+    """
+    Per-connection resource limits; a timeout of None or 0 disables it.
+    """
+    __slots__ = ("idle_timeout", "send_timeout", "max_connections", "max_output_buffer")
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, send_timeout=DEFAULT_SEND_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, max_output_buffer=DEFAULT_MAX_OUTPUT_BUFFER):
+        self.idle_timeout = idle_timeout or None
+        self.send_timeout = send_timeout or None
+        self.max_connections = max_connections
+        self.max_output_buffer = max_output_buffer
+
+
+class ClientConnection:
+    """
+    A connected client socket and the lock held while one of its commands runs.
+    """
+    __slots__ = ("socket", "address", "lock")
+
+    def __init__(self, client_socket, address):
+        self.socket = client_socket
+        self.address = address
+        self.lock = threading.Lock()
+
+
+class ConnectionRegistry:
+    """
+    Lock-protected set of the open client connections.
+    """
+
+    def __init__(self):
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    def add(self, client_socket, address):
+        """
+        Register a newly accepted client socket and return its ClientConnection.
+        """
+        connection = ClientConnection(client_socket, address)
+        with self._lock:
+            self._connections.add(connection)
+        return connection
+
+    def remove(self, connection):
+        """
+        Forget a connection once its handler is done with it.
+        """
+        with self._lock:
+            self._connections.discard(connection)
+
+    def connections(self):
+        """
+        Return a list of the open connections.
+        """
+        with self._lock:
+            return list(self._connections)
+
+    def __len__(self):
+        return len(self._connections)
+
+    def limit_output(self, client_socket, limits):
+        """
+        Bound the kernel send buffer of a client socket to the output buffer limit.
+        """
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, limits.max_output_buffer)
+
+    def abort(self, client_socket):
+        """
+        Reset a client's connection, discarding the response data still queued for it.
+        """
+        try:
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        except OSError:
+            pass
+
+    def reject(self, client_socket):
+        """
+        Turn away a newly accepted client because max_connections is reached.
+        """
+        try:
+            client_socket.settimeout(1.0)
+            client_socket.sendall(REJECT_NOTICE)
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+
+    def drain(self, deadline, notice):
+        """
+        Close every connection once its current command has finished.
+
+        Waits until the time.monotonic() deadline at the latest. Each client
+        that is between commands is sent the notice frame before its socket is
+        shut down. Returns the number of connections still running a command
+        at the deadline.
+        """
+        busy = 0
+        for connection in self.connections():
+            acquired = connection.lock.acquire(timeout=max(0.0, deadline - time.monotonic()))
+            try:
+                if acquired:
+                    # Do not let a client that stopped reading hold up the shutdown
+                    connection.socket.settimeout(max(0.1, deadline - time.monotonic()))
+                    connection.socket.sendall(notice)
+                else:
+                    busy += 1
+            except OSError:
+                pass
+            finally:
+                try:
+                    connection.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                if acquired:
+                    connection.lock.release()
+        return busy
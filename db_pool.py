@@ -0,0 +1,159 @@
+# Import necessary libraries
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Default number of connections a pool may open
+DEFAULT_POOL_SIZE = 8
+
+# Seconds a connection waits on a locked database before giving up
+BUSY_TIMEOUT_SECONDS = 5.0
+
+# Number of prepared statements each connection keeps cached
+CACHED_STATEMENTS = 256
+
+# PRAGMAs applied to every new connection. WAL lets readers run while a writer
+# commits, and synchronous=NORMAL only fsyncs at checkpoints instead of on
+# every commit, which is still safe against corruption in WAL mode.
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+)
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection becomes available within the requested timeout.
+    """
+
+
+class ConnectionPool:
+    """
+    A bounded pool of pre-configured SQLite connections shared by all threads.
+
+    Connections are opened lazily up to max_size and handed out most recently
+    used first, so a small set of connections stays warm with cached statements.
+    """
+
+    def __init__(self, database, max_size=DEFAULT_POOL_SIZE, busy_timeout=BUSY_TIMEOUT_SECONDS):
+        self.database = database
+        self.max_size = max_size
+        self.busy_timeout = busy_timeout
+        self._idle = []
+        self._created = 0
+        self._waiting = 0
+        self._closed = False
+        self._available = threading.Condition()
+
+    def open_connection(self):
+        """
+        Open and configure a new connection. The caller owns it and must close it.
+        """
+        conn = sqlite3.connect(self.database, timeout=self.busy_timeout,
+                               check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self, timeout=None):
+        """
+        Take a connection from the pool, opening a new one if the pool is not full.
+
+        Raises PoolTimeout if none becomes available within timeout seconds.
+        """
+        with self._available:
+            self._waiting += 1
+            try:
+                ready = self._available.wait_for(
+                    lambda: self._closed or self._idle or self._created < self.max_size, timeout)
+            finally:
+                self._waiting -= 1
+            if self._closed:
+                raise PoolTimeout("connection pool is closed")
+            if not ready:
+                raise PoolTimeout(f"no database connection available after {timeout} seconds")
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+
+        try:
+            return self.open_connection()
+        except Exception:
+            # Give the slot back so another caller can try again
+            with self._available:
+                self._created -= 1
+                self._available.notify()
+            raise
+
+    def release(self, conn):
+        """
+        Return a connection to the pool, rolling back anything left uncommitted.
+        """
+        if conn.in_transaction:
+            conn.rollback()
+        with self._available:
+            if self._closed:
+                self._created -= 1
+                conn.close()
+                return
+            self._idle.append(conn)
+            self._available.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Borrow a connection for the duration of a with block.
+        """
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        """
+        Return the number of open, idle and borrowed connections and of callers waiting for one.
+        """
+        with self._available:
+            return {
+                "open": self._created,
+                "idle": len(self._idle),
+                "in_use": self._created - len(self._idle),
+                "waiting": self._waiting,
+            }
+
+    def close(self):
+        """
+        Close all idle connections; borrowed ones are closed when released.
+        """
+        with self._available:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._created -= len(idle)
+            self._available.notify_all()
+        for conn in idle:
+            conn.close()
+
+
+@contextmanager
+def immediate_transaction(conn):
+    """
+    Run a with block inside a BEGIN IMMEDIATE transaction.
+
+    The write lock is taken up front, so concurrent writers queue on the busy
+    timeout instead of failing halfway through. The transaction is committed
+    when the block finishes and rolled back if it raises.
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        yield cursor
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+    finally:
+        cursor.close()
@@ -0,0 +1,223 @@
+# Group commit for trades and deposits.
+#
+# Instead of every BUY, SELL and DEPOSIT paying for its own commit, handlers
+# hand their trade_engine operation to a single writer thread. The writer
+# collects operations until it has max_batch of them or max_delay seconds have
+# passed since the first one arrived, applies the whole batch in one
+# transaction and only then wakes up the waiting handlers. Each operation runs
+# inside its own SAVEPOINT, so a rejected order does not affect the rest of the
+# batch.
+#
+# Once the writer is stopped, or if its thread dies, submit() raises
+# WriterStopped and every operation still queued fails with it, so no handler
+# is left waiting for a commit that will never come.
+
+import logging
+import queue
+import threading
+import time
+
+# Default number of operations committed together
+DEFAULT_MAX_BATCH = 64
+
+# Default time in seconds the writer waits to fill a batch
+DEFAULT_MAX_DELAY = 0.002
+
+# Default synchronous setting for the writer's connection. Commits are shared
+# by a whole batch, so they can afford to fsync and acknowledged orders survive
+# a power loss.
+DEFAULT_SYNCHRONOUS = "FULL"
+
+# Values accepted for the writer's synchronous setting
+SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+logger = logging.getLogger(__name__)
+
+
+class WriterStopped(RuntimeError):
+    """
+    Raised for an operation submitted to, or still queued in, a writer that is not running.
+    """
+
+
+class _PendingOperation:
+    """
+    An operation waiting in the writer queue, and its outcome once applied.
+    """
+    __slots__ = ("function", "args", "result", "error", "done")
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitWriter:
+    """
+    A background thread that applies queued operations in batched transactions.
+    """
+
+    def __init__(self, pool, max_batch=DEFAULT_MAX_BATCH, max_delay=DEFAULT_MAX_DELAY,
+                 synchronous=DEFAULT_SYNCHRONOUS):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.synchronous = synchronous
+        self._queue = queue.Queue()
+        self._thread = None
+        # Set once the writer accepts no more operations; guarded by _lock so
+        # nothing is queued after the writer has failed what was left
+        self._closed = True
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._operations = 0
+        self._largest_batch = 0
+        # Batch sizes bucketed by powers of two: 1, 2, 4, 8, ...
+        self._batch_sizes = {}
+
+    def start(self):
+        """
+        Start the writer thread.
+        """
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Apply everything already queued, then stop the writer thread.
+        """
+        if self._thread is not None:
+            with self._lock:
+                if not self._closed:
+                    self._queue.put(None)
+                self._closed = True
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, function, *args):
+        """
+        Queue function(cursor, *args) and wait until its batch is committed.
+
+        Returns the function's result, or raises the exception it raised.
+        Raises WriterStopped if the writer is stopped or has died.
+        """
+        operation = _PendingOperation(function, args)
+        with self._lock:
+            if self._closed:
+                raise WriterStopped("group commit writer is not running")
+            self._queue.put(operation)
+        operation.done.wait()
+        if operation.error is not None:
+            raise operation.error
+        return operation.result
+
+    def stats(self):
+        """
+        Return a snapshot of the batching statistics.
+        """
+        with self._stats_lock:
+            return {
+                "batches": self._batches,
+                "operations": self._operations,
+                "largest_batch": self._largest_batch,
+                "average_batch": self._operations / self._batches if self._batches else 0.0,
+                "batch_sizes": dict(sorted(self._batch_sizes.items())),
+                "queued": self._queue.qsize(),
+            }
+
+    def _run(self):
+        """
+        Writer thread main loop.
+        """
+        batch = []
+        try:
+            conn = self.pool.open_connection()
+            try:
+                conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+                stopping = False
+                while not stopping:
+                    operation = self._queue.get()
+                    if operation is None:
+                        break
+
+                    # Keep collecting until the batch is full or the window closes
+                    batch = [operation]
+                    deadline = time.monotonic() + self.max_delay
+                    while len(batch) < self.max_batch:
+                        remaining = deadline - time.monotonic()
+                        try:
+                            operation = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if operation is None:
+                            stopping = True
+                            break
+                        batch.append(operation)
+
+                    self._apply(conn, batch)
+            finally:
+                conn.close()
+        except Exception:
+            logger.exception("Group commit writer failed")
+        finally:
+            with self._lock:
+                self._closed = True
+            self._fail_pending(batch)
+
+    def _fail_pending(self, batch):
+        """
+        Release the waiters of every operation the stopped writer will not apply.
+        """
+        pending = [operation for operation in batch if not operation.done.is_set()]
+        while True:
+            try:
+                operation = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if operation is not None:
+                pending.append(operation)
+        for operation in pending:
+            operation.error = WriterStopped("group commit writer stopped before applying the operation")
+            operation.done.set()
+
+    def _apply(self, conn, batch):
+        """
+        Apply one batch in a single transaction and release its waiters.
+        """
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for operation in batch:
+                cursor.execute("SAVEPOINT operation")
+                try:
+                    operation.result = operation.function(cursor, *operation.args)
+                except Exception as e:
+                    # Undo only this operation and keep going with the batch
+                    operation.error = e
+                    cursor.execute("ROLLBACK TO operation")
+                cursor.execute("RELEASE operation")
+            conn.commit()
+        except Exception as e:
+            # Nothing in the batch was committed
+            if conn.in_transaction:
+                conn.rollback()
+            for operation in batch:
+                if operation.error is None:
+                    operation.result = None
+                    operation.error = e
+        finally:
+            cursor.close()
+
+        with self._stats_lock:
+            self._batches += 1
+            self._operations += len(batch)
+            self._largest_batch = max(self._largest_batch, len(batch))
+            bucket = 1 << (len(batch) - 1).bit_length()
+            self._batch_sizes[bucket] = self._batch_sizes.get(bucket, 0) + 1
+
+        for operation in batch:
+            operation.done.set()
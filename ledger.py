@@ -0,0 +1,256 @@
+# Append-only ledger of every balance change, with snapshots and replay.
+#
+# BUY, SELL, BATCH and DEPOSIT add one Ledger row per order (one per leg for
+# BATCH) in the same transaction as the balance updates, so the ledger and the
+# Users and Stocks tables can never disagree. Triggers reject any UPDATE or
+# DELETE on Ledger. With group commit the rows of a whole batch are committed
+# together, so the ledger costs one extra INSERT per order and no extra commit.
+#
+# A snapshot copies every USD and stock balance together with the ID of the
+# last ledger row it includes. Replaying the ledger rows after the latest
+# snapshot onto it rebuilds all balances without reading the whole history.
+# Balances and changes are integer cents and micro-shares, so the replayed
+# balances must match the live ones exactly.
+# The server takes a snapshot every --ledger-snapshot-interval seconds and
+# keeps the latest RETAINED_SNAPSHOTS of them.
+#
+#     python ledger.py database.db verify      # replay and compare with the live balances
+#     python ledger.py database.db snapshot    # take a snapshot now
+#     python ledger.py database.db bench       # measure the ledger's cost per trade
+
+import argparse
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from db_pool import immediate_transaction
+from money import SHARE_SCALE, format_shares, format_usd
+
+# Default seconds between the server's balance snapshots
+DEFAULT_SNAPSHOT_INTERVAL = 600.0
+
+# Number of most recent snapshots kept when a new one is taken
+RETAINED_SNAPSHOTS = 3
+
+# Ledger rows fetched at a time while replaying
+REPLAY_CHUNK_ROWS = 10000
+
+logger = logging.getLogger(__name__)
+
+
+def record(cursor, kind, user_id, stock_symbol, stock_change, price, usd_change):
+    """
+    Append one balance change to the ledger, inside the caller's transaction.
+
+    stock_change (micro-shares) and usd_change (cents) are signed: a BUY adds
+    shares and removes dollars. DEPOSIT rows have no symbol, share change or
+    price.
+    """
+    cursor.execute("INSERT INTO Ledger (created_at, kind, user_id, stock_symbol, stock_change, price, usd_change) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                   (time.time(), kind, user_id, stock_symbol, stock_change, price, usd_change))
+
+
+def record_many(cursor, entries):
+    """
+    Append several (kind, user_id, stock_symbol, stock_change, price, usd_change) changes at once.
+    """
+    created_at = time.time()
+    cursor.executemany("INSERT INTO Ledger (created_at, kind, user_id, stock_symbol, stock_change, price, usd_change) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)", [(created_at,) + tuple(entry) for entry in entries])
+
+
+def snapshot(cursor):
+    """
+    Copy every balance into a new snapshot, inside the caller's transaction.
+
+    Returns the ID of the snapshot.
+    """
+    cursor.execute("INSERT INTO Snapshots (ledger_id, taken_at) "
+                   "VALUES ((SELECT coalesce(max(ID), 0) FROM Ledger), ?)", (time.time(),))
+    snapshot_id = cursor.lastrowid
+    cursor.execute("INSERT INTO SnapshotBalances (snapshot_id, user_id, stock_symbol, balance) "
+                   "SELECT ?, ID, NULL, usd_balance FROM Users", (snapshot_id,))
+    cursor.execute("INSERT INTO SnapshotBalances (snapshot_id, user_id, stock_symbol, balance) "
+                   "SELECT ?, user_id, stock_symbol, stock_balance FROM Stocks", (snapshot_id,))
+
+    # Older snapshots are only a fallback; the ledger itself is never pruned
+    cursor.execute("SELECT ID FROM Snapshots ORDER BY ID DESC LIMIT -1 OFFSET ?", (RETAINED_SNAPSHOTS,))
+    expired = [row[0] for row in cursor.fetchall()]
+    if expired:
+        cursor.executemany("DELETE FROM SnapshotBalances WHERE snapshot_id = ?", [(ID,) for ID in expired])
+        cursor.executemany("DELETE FROM Snapshots WHERE ID = ?", [(ID,) for ID in expired])
+    return snapshot_id
+
+
+def take_snapshot(conn):
+    """
+    Take a snapshot in its own transaction and return its ID.
+    """
+    with immediate_transaction(conn) as cursor:
+        return snapshot(cursor)
+
+
+def start_snapshots(pool, interval, stop):
+    """
+    Take a snapshot every interval seconds on a background thread until the
+    stop Event is set. Returns the thread.
+    """
+    def snapshot_loop():
+        while not stop.wait(interval):
+            try:
+                with pool.connection() as conn:
+                    started = time.perf_counter()
+                    snapshot_id = take_snapshot(conn)
+                logger.info(f"Took ledger snapshot {snapshot_id} in {(time.perf_counter() - started) * 1000:.1f} ms")
+            except Exception as e:
+                logger.warning(f"Ledger snapshot failed: {e}")
+
+    thread = threading.Thread(target=snapshot_loop, name="ledger-snapshots", daemon=True)
+    thread.start()
+    return thread
+
+
+def replay(conn, snapshot_id=None):
+    """
+    Rebuild every balance from a snapshot, the latest by default, and the ledger rows after it.
+
+    Returns a tuple of (cash, stocks, entries replayed), where cash maps
+    user_id to its USD balance and stocks maps (user_id, stock_symbol) to its
+    share balance. Raises LookupError if there is no such snapshot.
+    """
+    cursor = conn.cursor()
+    # Read the snapshot and the ledger from one consistent view of the database
+    cursor.execute("BEGIN")
+    try:
+        if snapshot_id is None:
+            cursor.execute("SELECT ID, ledger_id FROM Snapshots ORDER BY ID DESC LIMIT 1")
+        else:
+            cursor.execute("SELECT ID, ledger_id FROM Snapshots WHERE ID = ?", (snapshot_id,))
+        row = cursor.fetchone()
+        if row is None:
+            raise LookupError("no ledger snapshot to replay from")
+        snapshot_id, ledger_id = row
+
+        cash = {}
+        stocks = {}
+        cursor.execute("SELECT user_id, stock_symbol, balance FROM SnapshotBalances WHERE snapshot_id = ?",
+                       (snapshot_id,))
+        for user_id, stock_symbol, balance in cursor.fetchall():
+            if stock_symbol is None:
+                cash[user_id] = balance
+            else:
+                stocks[user_id, stock_symbol] = balance
+
+        entries = 0
+        cursor.execute("SELECT user_id, stock_symbol, stock_change, usd_change FROM Ledger WHERE ID > ? ORDER BY ID",
+                       (ledger_id,))
+        while True:
+            rows = cursor.fetchmany(REPLAY_CHUNK_ROWS)
+            if not rows:
+                break
+            entries += len(rows)
+            for user_id, stock_symbol, stock_change, usd_change in rows:
+                cash[user_id] = cash.get(user_id, 0) + usd_change
+                if stock_symbol is not None:
+                    stocks[user_id, stock_symbol] = stocks.get((user_id, stock_symbol), 0) + stock_change
+        return cash, stocks, entries
+    finally:
+        conn.rollback()
+
+
+def verify(conn, snapshot_id=None):
+    """
+    Replay the ledger and compare the result with the live balances.
+
+    Returns a tuple of (list of difference descriptions, entries replayed).
+    """
+    cash, stocks, entries = replay(conn, snapshot_id)
+    differences = []
+    for user_id, usd_balance in conn.execute("SELECT ID, usd_balance FROM Users"):
+        replayed = cash.pop(user_id, None)
+        if replayed != usd_balance:
+            differences.append(f"user {user_id} USD: live {format_usd(usd_balance)}, replayed "
+                               f"{format_usd(replayed) if replayed is not None else None}")
+    for user_id, stock_symbol, stock_balance in conn.execute("SELECT user_id, stock_symbol, stock_balance FROM Stocks"):
+        replayed = stocks.pop((user_id, stock_symbol), 0)
+        if replayed != stock_balance:
+            differences.append(f"user {user_id} {stock_symbol}: live {format_shares(stock_balance)}, "
+                               f"replayed {format_shares(replayed)}")
+    differences.extend(f"user {user_id} USD: missing, replayed {format_usd(balance)}" for user_id, balance in cash.items())
+    differences.extend(f"user {user_id} {stock_symbol}: missing, replayed {format_shares(balance)}"
+                       for (user_id, stock_symbol), balance in stocks.items() if balance)
+    return differences, entries
+
+
+def benchmark(trades):
+    """
+    Print the time per BUY with and without the ledger on a scratch database.
+    """
+    import trade_engine
+    from db_pool import ConnectionPool
+    from migrations import migrate
+
+    with tempfile.TemporaryDirectory() as directory:
+        pool = ConnectionPool(os.path.join(directory, "bench.db"))
+        with pool.connection() as conn:
+            migrate(conn)
+            conn.execute("UPDATE Users SET usd_balance = ?", (10 ** 14,))
+            conn.commit()
+            results = {}
+            for write_ledger in (False, True, False, True):
+                trade_engine.write_ledger = write_ledger
+                started = time.perf_counter()
+                for number in range(trades):
+                    trade_engine.execute(conn, trade_engine.apply_buy, 1, f"S{number % 50}", SHARE_SCALE, 100)
+                results.setdefault(write_ledger, []).append((time.perf_counter() - started) / trades)
+            trade_engine.write_ledger = True
+            started = time.perf_counter()
+            cash, stocks, entries = replay(conn)
+            replay_time = time.perf_counter() - started
+        pool.close()
+
+    # The best of two runs each, so warm-up does not count against either
+    without, with_ledger = min(results[False]), min(results[True])
+    print(f"BUY without ledger {without * 1e6:8.1f} us")
+    print(f"BUY with ledger    {with_ledger * 1e6:8.1f} us  (+{(with_ledger - without) * 1e6:.1f} us, "
+          f"{(with_ledger / without - 1) * 100:+.1f}%)")
+    print(f"Replayed {entries} ledger rows in {replay_time * 1000:.1f} ms")
+
+
+# Replay, verify or snapshot a database file without starting the server
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trade ledger tools")
+    parser.add_argument("database", nargs="?", default="database.db")
+    parser.add_argument("action", choices=("verify", "replay", "snapshot", "bench"))
+    parser.add_argument("--snapshot-id", type=int, help="replay from this snapshot instead of the latest")
+    parser.add_argument("--trades", type=int, default=5000, help="trades per bench run")
+    args = parser.parse_args()
+
+    if args.action == "bench":
+        benchmark(args.trades)
+    else:
+        connection = sqlite3.connect(args.database)
+        started = time.perf_counter()
+        if args.action == "snapshot":
+            print(f"[*] Took snapshot {take_snapshot(connection)}")
+        elif args.action == "replay":
+            cash, stocks, entries = replay(connection, args.snapshot_id)
+            for user_id, balance in sorted(cash.items()):
+                print(f"{user_id} USD {format_usd(balance)}")
+            for (user_id, stock_symbol), balance in sorted(stocks.items()):
+                print(f"{user_id} {stock_symbol} {format_shares(balance)}")
+            print(f"[*] Replayed {entries} ledger rows")
+        else:
+            differences, entries = verify(connection, args.snapshot_id)
+            for difference in differences:
+                print(difference)
+            print(f"[*] Replayed {entries} ledger rows: "
+                  f"{'OK' if not differences else f'{len(differences)} differences'}")
+        print(f"[*] Done in {(time.perf_counter() - started) * 1000:.1f} ms")
+        connection.close()
+        if args.action == "verify" and differences:
+            raise SystemExit(1)
@@ -0,0 +1,163 @@
+# Server metrics.
+#
+# Every command run by the server is recorded with its total latency and the
+# part of it spent writing to the client socket; the rest is time spent in the
+# handler and the database. Latencies go into fixed histogram buckets, so
+# recording costs one lock and a few additions no matter how long the server
+# runs. Counters count events such as accepted connections, and gauges are
+# callables read when a snapshot is taken, for values other modules already
+# track (sessions, pool and queue depths, cache and lock statistics).
+#
+# The root-only STATS command returns format_snapshot(), and the server can
+# log it periodically with --stats-interval.
+
+import bisect
+import logging
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets in milliseconds; the last bucket is unbounded
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+logger = logging.getLogger(__name__)
+
+
+class _CommandStats:
+    """
+    Counters and latency histogram of one command.
+    """
+    __slots__ = ("count", "errors", "total_time", "socket_time", "max_time", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.socket_time = 0.0
+        self.max_time = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def percentile_ms(self, percent):
+        """
+        Upper bound of the histogram bucket holding the given percentile.
+        """
+        rank = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                if index < len(LATENCY_BUCKETS_MS):
+                    return LATENCY_BUCKETS_MS[index]
+                break
+        return self.max_time * 1000
+
+
+class Metrics:
+    """
+    Thread-safe per-command latencies, counters and gauges.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._commands = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def record(self, command, status, total_time, socket_time):
+        """
+        Record one command that took total_time seconds, socket_time of them sending.
+        """
+        with self._lock:
+            stats = self._commands.get(command)
+            if stats is None:
+                stats = self._commands[command] = _CommandStats()
+            stats.count += 1
+            if status != 200:
+                stats.errors += 1
+            stats.total_time += total_time
+            stats.socket_time += socket_time
+            if total_time > stats.max_time:
+                stats.max_time = total_time
+            stats.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, total_time * 1000)] += 1
+
+    def increment(self, counter, amount=1):
+        """
+        Add amount to a named counter.
+        """
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    def counter(self, counter):
+        """
+        Return the current value of a named counter.
+        """
+        with self._lock:
+            return self._counters.get(counter, 0)
+
+    def gauge(self, name, read):
+        """
+        Register read() to be called for the current value of name in every snapshot.
+        """
+        self._gauges[name] = read
+
+    def snapshot(self):
+        """
+        Return all metrics as a dict.
+        """
+        with self._lock:
+            commands = {}
+            for name, stats in sorted(self._commands.items()):
+                commands[name] = {
+                    "count": stats.count,
+                    "errors": stats.errors,
+                    "average_ms": stats.total_time * 1000 / stats.count,
+                    "db_ms": (stats.total_time - stats.socket_time) * 1000 / stats.count,
+                    "socket_ms": stats.socket_time * 1000 / stats.count,
+                    "p50_ms": stats.percentile_ms(50),
+                    "p99_ms": stats.percentile_ms(99),
+                    "max_ms": stats.max_time * 1000,
+                }
+            counters = dict(self._counters)
+        gauges = {}
+        for name, read in self._gauges.items():
+            try:
+                gauges[name] = read()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+        return {"uptime_seconds": time.time() - self.started, "counters": counters, "gauges": gauges,
+                "commands": commands}
+
+    def format_snapshot(self):
+        """
+        Return the snapshot as text, one metric per line.
+        """
+        snapshot = self.snapshot()
+        lines = [f"uptime_seconds {snapshot['uptime_seconds']:.1f}"]
+        lines.extend(f"counter {name} {value}" for name, value in sorted(snapshot["counters"].items()))
+        for name, value in snapshot["gauges"].items():
+            if isinstance(value, dict):
+                value = " ".join(f"{key}={_format_value(item)}" for key, item in value.items())
+            lines.append(f"gauge {name} {_format_value(value)}")
+        for name, stats in snapshot["commands"].items():
+            lines.append(f"command {name} " + " ".join(f"{key}={_format_value(value)}" for key, value in stats.items()))
+        return "\n".join(lines) + "\n"
+
+    def start_dumps(self, interval, stop):
+        """
+        Log the snapshot every interval seconds on a background thread until the
+        stop Event is set. Returns the thread.
+        """
+        def dump_loop():
+            while not stop.wait(interval):
+                logger.info("metrics\n%s", self.format_snapshot())
+
+        thread = threading.Thread(target=dump_loop, name="metrics-dump", daemon=True)
+        thread.start()
+        return thread
+
+
+def _format_value(value):
+    """
+    Format floats with three decimals and everything else as is.
+    """
+    return f"{value:.3f}" if isinstance(value, float) else str(value)
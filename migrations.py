@@ -0,0 +1,270 @@
+# Versioned schema migrations for the trading database.
+#
+# The schema version is kept in SQLite's PRAGMA user_version. At startup the
+# server calls migrate(), which applies every migration newer than the recorded
+# version, each in its own transaction together with the version bump, so an
+# existing database.db is upgraded in place and a crash mid-upgrade leaves it
+# at the last completed version.
+#
+# To change the schema, append a new (version, description, function) entry to
+# MIGRATIONS. Never edit a migration that has already shipped.
+
+import logging
+import sqlite3
+import sys
+
+import ledger
+from db_pool import immediate_transaction
+from money import SHARE_SCALE, USD_SCALE
+
+logger = logging.getLogger(__name__)
+
+
+def _create_tables(cursor):
+    """
+    Create the original tables and the default users.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Users (
+            ID INTEGER PRIMARY KEY AUTOINCREMENT,
+            first_name TEXT,
+            last_name TEXT,
+            user_name TEXT NOT NULL,
+            password TEXT,
+            usd_balance DOUBLE NOT NULL
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Stocks (
+            ID INTEGER PRIMARY KEY AUTOINCREMENT,
+            stock_symbol VARCHAR(4) NOT NULL,
+            stock_name VARCHAR(20) NOT NULL,
+            stock_balance DOUBLE,
+            user_id INTEGER,
+            FOREIGN KEY (user_id) REFERENCES Users (ID)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ActiveUsers (
+            ID INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            user_name TEXT NOT NULL,
+            ip_address TEXT NOT NULL,
+            port TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES Users (ID)
+        )
+    ''')
+
+    # Insert the default user and the root user unless they already exist
+    for user in (('John', 'Doe', 'John', 'John01', 100.0), ('Root', 'User', 'Root', 'Root01', 1000000.0)):
+        cursor.execute("SELECT 1 FROM Users WHERE user_name = ?", (user[2],))
+        if cursor.fetchone() is None:
+            cursor.execute("INSERT INTO Users (first_name, last_name, user_name, password, usd_balance) "
+                           "VALUES (?, ?, ?, ?, ?)", user)
+
+
+def _add_indexes(cursor):
+    """
+    Index the columns used by LOGIN, BUY/SELL/LIST and DEPOSIT lookups.
+    """
+    # Older databases may hold several rows for the same holding. Fold them into
+    # the oldest row so the unique index can be built.
+    cursor.execute('''
+        UPDATE Stocks SET stock_balance = (
+            SELECT SUM(other.stock_balance) FROM Stocks AS other
+            WHERE other.user_id IS Stocks.user_id AND other.stock_symbol = Stocks.stock_symbol
+        )
+        WHERE ID IN (SELECT MIN(ID) FROM Stocks GROUP BY user_id, stock_symbol HAVING COUNT(*) > 1)
+    ''')
+    cursor.execute('''
+        DELETE FROM Stocks
+        WHERE ID NOT IN (SELECT MIN(ID) FROM Stocks GROUP BY user_id, stock_symbol)
+    ''')
+
+    # One holding row per user and symbol, which lets BUY upsert into it
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_stocks_user_symbol ON Stocks (user_id, stock_symbol)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_user_name ON Users (user_name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_active_users_address ON ActiveUsers (ip_address, port)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_active_users_user_id ON ActiveUsers (user_id)")
+
+
+def _index_stock_symbols(cursor):
+    """
+    Index holdings by symbol for LOOKUP across all users.
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stocks_symbol ON Stocks (stock_symbol)")
+
+
+def _create_ledger(cursor):
+    """
+    Create the append-only trade ledger and its snapshots, starting from the current balances.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Ledger (
+            ID INTEGER PRIMARY KEY,
+            created_at REAL NOT NULL,
+            kind TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            stock_symbol TEXT,
+            stock_change DOUBLE,
+            price DOUBLE,
+            usd_change DOUBLE NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE TRIGGER IF NOT EXISTS ledger_no_update BEFORE UPDATE ON Ledger "
+                   "BEGIN SELECT RAISE(ABORT, 'the ledger is append-only'); END")
+    cursor.execute("CREATE TRIGGER IF NOT EXISTS ledger_no_delete BEFORE DELETE ON Ledger "
+                   "BEGIN SELECT RAISE(ABORT, 'the ledger is append-only'); END")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Snapshots (
+            ID INTEGER PRIMARY KEY,
+            ledger_id INTEGER NOT NULL,
+            taken_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS SnapshotBalances (
+            snapshot_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            stock_symbol TEXT,
+            balance DOUBLE
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_snapshot_balances ON SnapshotBalances (snapshot_id)")
+
+    # Balances from before the ledger existed are only known from this first snapshot
+    ledger.snapshot(cursor)
+
+
+def _rebuild_table(cursor, table, columns, select):
+    """
+    Replace table with one declared with columns and filled by the select from the old one.
+
+    The old table's indexes and triggers are dropped with it and must be
+    created again. An AUTOINCREMENT counter is carried over, so IDs of deleted
+    rows are still never reused.
+    """
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,))
+    sequence = cursor.fetchone()
+    cursor.execute(f"CREATE TABLE {table}_rebuilt ({columns})")
+    cursor.execute(f"INSERT INTO {table}_rebuilt {select}")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_rebuilt RENAME TO {table}")
+    if sequence is not None:
+        cursor.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+        cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, sequence[0]))
+
+
+def _use_fixed_point(cursor):
+    """
+    Store balances, prices and amounts as integer cents and micro-shares instead of DOUBLE.
+    """
+    # SQLite cannot change a column's type, so every table holding money is
+    # copied into a new one, with each value rounded to the nearest unit
+    cents = f"CAST(round({{}} * {USD_SCALE}) AS INTEGER)"
+    micro_shares = f"CAST(round({{}} * {SHARE_SCALE}) AS INTEGER)"
+    _rebuild_table(cursor, "Users", '''
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        first_name TEXT,
+        last_name TEXT,
+        user_name TEXT NOT NULL,
+        password TEXT,
+        usd_balance INTEGER NOT NULL
+    ''', f"SELECT ID, first_name, last_name, user_name, password, {cents.format('usd_balance')} FROM Users")
+    _rebuild_table(cursor, "Stocks", '''
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        stock_symbol VARCHAR(4) NOT NULL,
+        stock_name VARCHAR(20) NOT NULL,
+        stock_balance INTEGER NOT NULL,
+        user_id INTEGER,
+        FOREIGN KEY (user_id) REFERENCES Users (ID)
+    ''', f"SELECT ID, stock_symbol, stock_name, {micro_shares.format('coalesce(stock_balance, 0)')}, user_id "
+         f"FROM Stocks")
+    _rebuild_table(cursor, "Ledger", '''
+        ID INTEGER PRIMARY KEY,
+        created_at REAL NOT NULL,
+        kind TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        stock_symbol TEXT,
+        stock_change INTEGER,
+        price INTEGER,
+        usd_change INTEGER NOT NULL
+    ''', f"SELECT ID, created_at, kind, user_id, stock_symbol, {micro_shares.format('stock_change')}, "
+         f"{cents.format('price')}, {cents.format('usd_change')} FROM Ledger")
+    _rebuild_table(cursor, "SnapshotBalances", '''
+        snapshot_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        stock_symbol TEXT,
+        balance INTEGER
+    ''', f"SELECT snapshot_id, user_id, stock_symbol, CASE WHEN stock_symbol IS NULL "
+         f"THEN {cents.format('balance')} ELSE {micro_shares.format('balance')} END FROM SnapshotBalances")
+
+    cursor.execute("CREATE UNIQUE INDEX idx_stocks_user_symbol ON Stocks (user_id, stock_symbol)")
+    cursor.execute("CREATE INDEX idx_stocks_symbol ON Stocks (stock_symbol)")
+    cursor.execute("CREATE INDEX idx_users_user_name ON Users (user_name)")
+    cursor.execute("CREATE INDEX idx_snapshot_balances ON SnapshotBalances (snapshot_id)")
+    cursor.execute("CREATE TRIGGER ledger_no_update BEFORE UPDATE ON Ledger "
+                   "BEGIN SELECT RAISE(ABORT, 'the ledger is append-only'); END")
+    cursor.execute("CREATE TRIGGER ledger_no_delete BEFORE DELETE ON Ledger "
+                   "BEGIN SELECT RAISE(ABORT, 'the ledger is append-only'); END")
+
+    # Each ledger row was rounded on its own, so replays start from the rounded balances
+    ledger.snapshot(cursor)
+
+
+# Every migration in order: (version it upgrades to, description, function)
+MIGRATIONS = [
+    (1, "create tables and default users", _create_tables),
+    (2, "add lookup indexes", _add_indexes),
+    (3, "index holdings by symbol", _index_stock_symbols),
+    (4, "create the trade ledger", _create_ledger),
+    (5, "store money as integer cents and micro-shares", _use_fixed_point),
+]
+
+# Version a fully migrated database reports
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    """
+    Return the schema version recorded in the database.
+    """
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """
+    Upgrade the database behind conn to SCHEMA_VERSION.
+
+    Returns the number of migrations applied.
+    """
+    version = get_schema_version(conn)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"database schema version {version} is newer than this server supports ({SCHEMA_VERSION})")
+
+    applied = 0
+    for target, description, upgrade in MIGRATIONS:
+        if target <= version:
+            continue
+        with immediate_transaction(conn) as cursor:
+            # Another process may have migrated while we waited for the write lock
+            if get_schema_version(conn) >= target:
+                continue
+            upgrade(cursor)
+            cursor.execute(f"PRAGMA user_version = {target}")
+        applied += 1
+        logger.info(f"Migrated database to schema version {target}: {description}")
+    return applied
+
+
+# Upgrade a database file without starting the server
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[*] %(message)s")
+    database = sys.argv[1] if len(sys.argv) > 1 else 'database.db'
+    connection = sqlite3.connect(database)
+    migrate(connection)
+    print(f"[*] {database} is at schema version {get_schema_version(connection)}")
+    connection.close()
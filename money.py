@@ -0,0 +1,94 @@
+# Fixed-point money and share quantities.
+#
+# USD amounts are stored and computed as whole cents and share quantities as
+# whole micro-shares, in INTEGER columns. Sums and comparisons of balances are
+# therefore exact, where DOUBLE balances drifted by a rounding error with every
+# trade. Only the value of an order, shares times price, is rounded: once, to
+# the nearest cent, and the same rounded value is both charged and recorded in
+# the ledger.
+#
+# Client input is parsed from its decimal text straight into units, and
+# responses format units back to decimal text, so no binary float is involved
+# at either end.
+
+import decimal
+
+# Units per dollar: balances and prices are in cents
+USD_SCALE = 100
+
+# Units per share: holdings and order amounts are in micro-shares
+SHARE_SCALE = 1000000
+
+# Largest amount accepted from a client, and largest order value, in units.
+# The product of two such amounts does not fit SQLite's 64-bit integers, so
+# trade_engine rejects orders worth more than this before writing anything.
+MAX_UNITS = 10 ** 15
+
+# Largest balance or holding an order may leave behind, in units. Balances are
+# added to in SQL, where going past 2 ** 63 would silently turn them into
+# floating point numbers, so trade_engine keeps them at or below this.
+MAX_BALANCE = 10 ** 18
+
+
+def parse_usd(text):
+    """
+    Argument converter for a non-negative dollar amount with at most 2 decimal places; returns cents.
+    """
+    return _parse_units(text, USD_SCALE, 2, "dollar amount")
+
+
+def parse_shares(text):
+    """
+    Argument converter for a non-negative number of shares with at most 6 decimal places; returns micro-shares.
+    """
+    return _parse_units(text, SHARE_SCALE, 6, "share amount")
+
+
+def _parse_units(text, scale, places, kind):
+    """
+    Convert non-negative decimal text to an integer number of 1/scale units, refusing to round.
+
+    scale is 10 ** places. Plain amounts such as '3' or '1.35' are converted
+    with string operations; anything else, such as a sign or an exponent,
+    goes through Decimal, which is about ten times slower.
+    """
+    whole, _, fraction = text.partition(".")
+    if whole.isdigit() and whole.isascii() and len(fraction) <= places and (fraction.isdigit() or not fraction):
+        value = int(whole) * scale + (int(fraction.ljust(places, "0")) if fraction else 0)
+        if value > MAX_UNITS:
+            raise ValueError(f"{kind} out of range: {text}")
+        return value
+    try:
+        value = decimal.Decimal(text) * scale
+    except decimal.InvalidOperation:
+        raise ValueError(f"not a number: {text}") from None
+    if not value.is_finite() or value != value.to_integral_value() or value < 0:
+        raise ValueError(f"invalid {kind}: {text}")
+    if value > MAX_UNITS:
+        raise ValueError(f"{kind} out of range: {text}")
+    return int(value)
+
+
+def order_value(stock_amount, stock_price):
+    """
+    Return the value in cents of stock_amount micro-shares at stock_price cents,
+    rounded half up to the nearest cent.
+    """
+    return (stock_amount * stock_price + SHARE_SCALE // 2) // SHARE_SCALE
+
+
+def format_usd(cents):
+    """
+    Format cents as a dollar amount with two decimal places, e.g. 1234.50.
+    """
+    whole, fraction = divmod(abs(cents), USD_SCALE)
+    return f"{'-' if cents < 0 else ''}{whole}.{fraction:02d}"
+
+
+def format_shares(units):
+    """
+    Format micro-shares as a number of shares without trailing zeros, e.g. 3 or 3.4.
+    """
+    whole, fraction = divmod(abs(units), SHARE_SCALE)
+    text = f"{whole}.{fraction:06d}".rstrip("0").rstrip(".") if fraction else str(whole)
+    return f"-{text}" if units < 0 else text
@@ -0,0 +1,106 @@
+# In-memory symbol table and price book.
+#
+# BUY and SELL execute at the price listed here instead of the price the client
+# sends, which is only checked as a limit: a buy is rejected if the listed price
+# is above it and a sell if the listed price is below it. The book is loaded at
+# startup from a CSV snapshot with symbol,name,price columns, and the root user
+# can change prices or list new symbols with the PRICE command. Every listed
+# symbol is also added to the symbol index LOOKUP searches. Prices are integer
+# cents.
+
+import csv
+import os
+import threading
+
+from money import format_usd, parse_usd
+
+# Price snapshot loaded when the server is started without --prices
+DEFAULT_PRICES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prices.csv")
+
+
+class Listing:
+    """
+    A listed stock: its symbol, company name and current price in cents.
+    """
+    __slots__ = ("symbol", "name", "price")
+
+    def __init__(self, symbol, name, price):
+        self.symbol = symbol
+        self.name = name
+        self.price = price
+
+
+class PriceBook:
+    """
+    Thread-safe symbol table with current prices.
+    """
+
+    def __init__(self):
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._listings)
+
+    def load_csv(self, path):
+        """
+        Add or update the listings in a symbol,name,price CSV file.
+
+        A header row is skipped. Returns the number of listings read. Raises
+        ValueError naming the line of the first malformed row.
+        """
+        listings = []
+        with open(path, newline="") as prices:
+            for line_number, row in enumerate(csv.reader(prices), 1):
+                if not row or row[0].startswith("#") or (line_number == 1 and row[0].strip().lower() == "symbol"):
+                    continue
+                try:
+                    symbol, name, price = (field.strip() for field in row)
+                    listings.append(_make_listing(symbol, name, parse_usd(price)))
+                except ValueError as e:
+                    raise ValueError(f"{path}:{line_number}: {e}") from None
+
+        with self._lock:
+            for listing in listings:
+                self._listings[listing.symbol] = listing
+        return len(listings)
+
+    def update(self, symbol, price, name=None):
+        """
+        Set the price of symbol in cents, listing it if it is new, and return its Listing.
+
+        A new symbol without a name is listed under its symbol. Raises
+        ValueError for an invalid symbol or price.
+        """
+        with self._lock:
+            current = self._listings.get(symbol.upper())
+            if name is None:
+                name = current.name if current is not None else symbol.upper()
+            listing = _make_listing(symbol, name, price)
+            self._listings[listing.symbol] = listing
+        return listing
+
+    def quote(self, symbol):
+        """
+        Return the Listing of symbol, or None if it is not listed.
+        """
+        return self._listings.get(symbol.upper())
+
+    def listings(self):
+        """
+        Return a list of all listings.
+        """
+        with self._lock:
+            return list(self._listings.values())
+
+
+def _make_listing(symbol, name, price):
+    """
+    Validate the fields of a listing and return it with the symbol upper-cased.
+    """
+    symbol = symbol.upper()
+    if not symbol or not symbol.replace(".", "").replace("-", "").isalnum():
+        raise ValueError(f"invalid symbol: {symbol!r}")
+    if price <= 0:
+        raise ValueError(f"invalid price for {symbol}: {format_usd(price)}")
+    return Listing(symbol, name or symbol, price)
@@ -0,0 +1,127 @@
+# Wire protocol shared by the server and the client.
+#
+# Requests are single lines of UTF-8 text carrying a client chosen request ID:
+#
+#     <request_id> <COMMAND> [<arg> ...]\n
+#
+# Responses are length-prefixed so multi-line replies are never truncated or
+# merged. Each one starts with a fixed header holding the request ID it answers
+# and the payload length, both unsigned 32-bit big-endian integers:
+#
+#     <request_id><length><payload>
+#
+# Responses are sent in the order the requests were received, which lets a
+# client pipeline many commands over one connection without waiting for replies.
+#
+# A long response may be streamed as several frames for the same request. Every
+# frame but the last has MORE_FRAMES set in its length word, and the reader
+# joins the payloads back together.
+
+import struct
+
+# Header placed in front of every response payload
+RESPONSE_HEADER = struct.Struct("!II")
+
+# Bit set in the length word of every frame but the last one of a response
+MORE_FRAMES = 0x80000000
+
+# Longest request line the server accepts, including the newline
+MAX_REQUEST_LINE = 64 * 1024
+
+# Request ID used when the server cannot tell which request it is answering
+UNKNOWN_REQUEST_ID = 0
+
+
+def encode_request(request_id, command):
+    """
+    Encode a command string as a request line.
+    """
+    return f"{request_id} {command}\n".encode()
+
+
+def decode_request(line):
+    """
+    Decode a request line into its request ID and command parts.
+
+    Raises ValueError if the line is not valid UTF-8 or has no request ID.
+    """
+    parts = line.decode().split()
+    if not parts:
+        raise ValueError("empty request")
+    request_id = int(parts[0])
+    if request_id < 0 or request_id > 0xFFFFFFFF:
+        raise ValueError(f"request ID out of range: {request_id}")
+    return request_id, parts[1:]
+
+
+def encode_response(request_id, response):
+    """
+    Encode a response string as a length-prefixed frame.
+    """
+    payload = response.encode()
+    return RESPONSE_HEADER.pack(request_id, len(payload)) + payload
+
+
+def iter_response_frames(request_id, response):
+    """
+    Encode a response as the frames to send for it.
+
+    A string is sent as a single frame. Any other iterable of string chunks is
+    encoded lazily, one frame per chunk, so it never has to be held in memory
+    as a whole.
+    """
+    if isinstance(response, str):
+        yield encode_response(request_id, response)
+        return
+
+    previous = None
+    for chunk in response:
+        if previous is not None:
+            yield RESPONSE_HEADER.pack(request_id, len(previous) | MORE_FRAMES) + previous
+        previous = chunk.encode()
+    if previous is None:
+        previous = b""
+    yield RESPONSE_HEADER.pack(request_id, len(previous)) + previous
+
+
+def frame_status(frame):
+    """
+    Return the numeric status at the start of an encoded response frame, or None if it has none.
+    """
+    status = frame[RESPONSE_HEADER.size:RESPONSE_HEADER.size + 3]
+    return int(status) if len(status) == 3 and status.isdigit() else None
+
+
+def read_response(reader):
+    """
+    Read one complete response from a blocking binary file object.
+
+    Returns a (request_id, response) tuple, or None if the peer closed the connection.
+    """
+    payloads = []
+    while True:
+        header = reader.read(RESPONSE_HEADER.size)
+        if len(header) < RESPONSE_HEADER.size:
+            return None
+        request_id, length = RESPONSE_HEADER.unpack(header)
+        payload = reader.read(length & ~MORE_FRAMES)
+        if len(payload) < length & ~MORE_FRAMES:
+            return None
+        payloads.append(payload)
+        if not length & MORE_FRAMES:
+            return request_id, b"".join(payloads).decode()
+
+
+async def read_response_async(reader):
+    """
+    Read one complete response from an asyncio StreamReader.
+
+    Raises asyncio.IncompleteReadError if the peer closed the connection.
+    """
+    payloads = []
+    while True:
+        header = await reader.readexactly(RESPONSE_HEADER.size)
+        request_id, length = RESPONSE_HEADER.unpack(header)
+        payloads.append(await reader.readexactly(length & ~MORE_FRAMES))
+        if not length & MORE_FRAMES:
+            return request_id, b"".join(payloads).decode()
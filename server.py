@@ -1,220 +1,463 @@
 # Import necessary libraries
+import argparse
+import json
+import logging
+import random
+import signal
 import socket
-import sqlite3
 import sys
 import threading
+import time
 import os
 
+from cache import DEFAULT_MAX_ENTRIES, DEFAULT_TTL, BalanceCache
+from connections import (DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_CONNECTIONS, DEFAULT_MAX_OUTPUT_BUFFER,
+                         DEFAULT_SEND_TIMEOUT, IDLE_NOTICE, ConnectionLimits, ConnectionRegistry, send_within)
+from db_pool import ConnectionPool
+from dispatch import Dispatcher
+from group_commit import (DEFAULT_MAX_BATCH, DEFAULT_MAX_DELAY, DEFAULT_SYNCHRONOUS, SYNCHRONOUS_LEVELS,
+                          GroupCommitWriter, WriterStopped)
+from ledger import DEFAULT_SNAPSHOT_INTERVAL, start_snapshots as start_ledger_snapshots
+from metrics import Metrics
+from migrations import migrate
+from money import format_shares, format_usd, order_value, parse_shares, parse_usd
+from price_book import DEFAULT_PRICES_PATH, PriceBook
+from protocol import (MAX_REQUEST_LINE, UNKNOWN_REQUEST_ID, decode_request, encode_response, frame_status,
+                      iter_response_frames)
+from sessions import SessionRegistry
+from subscriptions import ALL_USERS, SubscriptionHub, thread_sender
+from symbol_index import SymbolIndex
+from trade_engine import LegRejected, TradeRejected, apply_batch, apply_buy, apply_deposit, apply_sell, execute
+from user_locks import DEFAULT_STRIPES, UserLockManager
+from workers import PrefixedReader, attach_worker, buffered_bytes, run_supervisor
+
 # Define server address and port
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 12345
 
+# Path of the SQLite database file
+DATABASE_PATH = 'database.db'
+
+# Maximum number of SQLite connections shared by all clients
+DB_POOL_SIZE = 8
+
+# Number of rows fetched and sent per frame by LIST, BALANCE and LOOKUP
+STREAM_CHUNK_ROWS = 500
+
+# Most legs a single BATCH order may have
+MAX_BATCH_LEGS = 1000
+
+# Number of threads doing database work for the asyncio server
+DB_WORKERS = 8
+
 #root user id
 root_user_id = 1
 
 # A global variable to keep track of whether the server is running
 is_server_running = True
 
+# Seconds a shutdown waits for running commands to finish before closing their connections
+DRAIN_TIMEOUT = 10.0
+
+# Sent to every connected client when the server shuts down
+SHUTDOWN_NOTICE = encode_response(UNKNOWN_REQUEST_ID, "503 Server shutting down")
+
+# Response to a command that failed unexpectedly; the error itself is only logged
+INTERNAL_ERROR = "500 Internal Server Error"
+
 # Define a list to keep track of all the client threads
 client_threads = []
 
-# Define a lock for database access
-db_lock = threading.Lock()
-
-# Connect to SQLite database
-conn = sqlite3.connect('database.db')
-cursor = conn.cursor()
-
-# Create tables if they do not exist
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS Users (
-        ID INTEGER PRIMARY KEY AUTOINCREMENT,
-        first_name TEXT,
-        last_name TEXT,
-        user_name TEXT NOT NULL,
-        password TEXT,
-        usd_balance DOUBLE NOT NULL
-    )
-''')
-
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS Stocks (
-        ID INTEGER PRIMARY KEY AUTOINCREMENT,
-        stock_symbol VARCHAR(4) NOT NULL,
-        stock_name VARCHAR(20) NOT NULL,
-        stock_balance DOUBLE,
-        user_id INTEGER,
-        FOREIGN KEY (user_id) REFERENCES Users (ID)
-    )
-''')
-
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS ActiveUsers (
-        ID INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        user_name TEXT NOT NULL,
-        ip_address TEXT NOT NULL,
-        port TEXT NOT NULL,
-        FOREIGN KEY (user_id) REFERENCES Users (ID)
-    )
-''')
-
-# Insert default user into Users table
-cursor.execute("SELECT * FROM Users WHERE user_name = ?", ('John',))
-existing_user = cursor.fetchone()
-
-if not existing_user:
-    cursor.execute("INSERT INTO Users (first_name, last_name, user_name, password, usd_balance) VALUES (?, ?, ?, ?, ?)",
-                   ('John', 'Doe', 'John', 'John01', 100.0))
-    conn.commit()
-
-# Insert root user for testing shutdown
-cursor.execute("SELECT * FROM Users WHERE user_name = ?", ('Root',))
-root_user = cursor.fetchone()
-
-if not root_user:
-    cursor.execute("INSERT INTO Users (first_name, last_name, user_name, password, usd_balance) VALUES (?, ?, ?, ?, ?)",
-                   ('Root', 'User', 'Root', 'Root01', 1000000.0))
-    conn.commit()
-
-# Close database connection after initial setup
-# conn.close()
+# Connections of the threaded server, closed between commands when shutting down
+client_connections = ConnectionRegistry()
 
+# Idle, send and connection count limits applied to every client
+connection_limits = ConnectionLimits()
 
-# Define functions to process different commands
+# Listening socket of the threaded server, shut down to stop accepting clients
+listening_socket = None
+
+# Set to stop the asyncio server
+async_stop = threading.Event()
+
+# Per-user locks serializing each user's trades and deposits
+user_locks = UserLockManager()
 
-def process_buy_command(conn, cursor, command_parts):
+# Listed symbols and the prices BUY and SELL execute at; empty if no snapshot was loaded
+price_book = PriceBook()
+
+# Every listed or held symbol, searched by LOOKUP
+symbol_index = SymbolIndex()
+
+# Shared pool of SQLite connections used by every command handler; replaced by
+# configure(), and connections are only opened when first used
+db_pool = ConnectionPool(DATABASE_PATH, DB_POOL_SIZE)
+
+# Clients that are currently logged in
+active_sessions = SessionRegistry()
+
+# Cache of per-user balances and holdings
+balance_cache = BalanceCache()
+
+# Connections that asked with SUBSCRIBE to be sent balance changes
+subscriptions = SubscriptionHub()
+
+# Group commit writer for trades and deposits, or None to commit each one on its own
+trade_writer = None
+
+# This process's shard of the users when running with --workers, otherwise None
+shard = None
+
+
+# Set when the server stops, ending the background threads started by configure()
+background_stop = threading.Event()
+background_threads = []
+
+def create_metrics():
     """
-    Process the 'BUY' command to buy stocks.
+    Return a fresh Metrics with the server's gauges registered.
     """
-    # Extract relevant information from command_parts and cast to appropriate types
-    try:
-        ticker = command_parts[1]
-        stock_amount = float(command_parts[2])
-        stock_price = float(command_parts[3])
-        user_id = int(command_parts[4])
-    except IndexError:
-        return "400 invalid command, missing arguments"
-    except ValueError:
-        return "400 invalid command, invalid arguments"
-    except Exception as e:
-        return f"400 invalid command, an error occurred: {e}"
+    metrics = Metrics()
+    metrics.gauge("connections_active", lambda: metrics.counter("connections_accepted")
+                  - metrics.counter("connections_closed"))
+    metrics.gauge("sessions_active", lambda: len(active_sessions))
+    metrics.gauge("db_pool", lambda: db_pool.stats())
+    metrics.gauge("group_commit", lambda: trade_writer.stats() if trade_writer is not None else "off")
+    metrics.gauge("balance_cache", lambda: balance_cache.stats())
+    metrics.gauge("user_locks", lambda: user_locks.stats())
+    metrics.gauge("subscriptions", lambda: subscriptions.stats())
+    return metrics
 
-    # Check if the user exists
-    cursor.execute("SELECT COUNT(*) FROM Users WHERE ID = ?", (user_id,))
-    user_exists = cursor.fetchone()[0]
+# Per-command latencies, counters and gauges reported by STATS
+server_metrics = create_metrics()
 
-    if not user_exists:
-        return f"400 user {user_id} not found."
+# Server log; every request is logged at DEBUG level, or a random sample of them
+logger = logging.getLogger("server")
+log_sample_rate = 1.0
 
-    # Perform necessary operations
-    # Fetch user's balance
-    cursor.execute("SELECT usd_balance FROM Users WHERE ID = ?", (user_id,))
-    user_balance = cursor.fetchone()[0]
+# Routes each command to its handler; commands sent before logging in get the login help
+dispatcher = Dispatcher(root_user_id, not_logged_in=lambda: process_help_command())
 
-    # Calculate the total cost of buying the stocks
-    total_cost = stock_amount * stock_price
 
-    # Check if the user has enough funds
-    if user_balance < total_cost:
-        return "400 insufficient funds"
-    else:
-        # Deduct the total cost from the user's balance
-        new_balance = user_balance - total_cost
-        cursor.execute("UPDATE Users SET usd_balance = ? WHERE ID = ?", (new_balance, user_id))
-
-        # Check if the user already owns stocks of the given ticker
-        cursor.execute("SELECT stock_balance FROM Stocks WHERE user_id = ? AND stock_symbol = ?", (user_id, ticker))
-        existing_stock_balance = cursor.fetchone()
-
-        if existing_stock_balance is None:
-            # Insert a new record for the user's stocks
-            cursor.execute("INSERT INTO Stocks (stock_symbol, stock_name, stock_balance, user_id) VALUES (?, ?, ?, ?)",
-                           (ticker, "", stock_amount, user_id))
-            updated_stock_balance = stock_amount  # Set the updated balance
-        else:
-            # Update the existing stock balance
-            updated_stock_balance = existing_stock_balance[0] + stock_amount
-            cursor.execute("UPDATE Stocks SET stock_balance = ? WHERE user_id = ? AND stock_symbol = ?",
-                           (updated_stock_balance, user_id, ticker))
+# Define functions to process different commands
 
-        # Commit the transaction
-        conn.commit()
+def run_trade(conn, operation, *args):
+    """
+    Apply a trade_engine operation and return its result.
 
-        # Generate appropriate response
-        response = f"200 OK\nBOUGHT: New balance: {updated_stock_balance} {ticker}. USD balance ${new_balance}"
-        return response
+    With group commit enabled the operation is queued for the writer thread and
+    this waits until its batch is committed; otherwise it runs in its own
+    transaction on conn. Raises TradeRejected with a 503 if the writer stopped
+    before applying the operation.
+    """
+    if trade_writer is not None:
+        try:
+            return trade_writer.submit(operation, *args)
+        except WriterStopped as e:
+            raise TradeRejected(f"503 Order not applied: {e}") from None
+    return execute(conn, operation, *args)
+
+def price_order(ticker, limit_price, buying):
+    """
+    Return the (symbol, name, price) an order for ticker executes at, with prices in cents.
 
-def process_sell_command(conn, cursor, command_parts):
+    With a price book loaded, orders trade at the listed price and the client's
+    price is a limit; without one, the client's price is used as before.
+    Raises TradeRejected if the symbol is not listed or the limit is crossed.
     """
-    Process the 'SELL' command to sell stocks.
+    if limit_price <= 0:
+        raise TradeRejected("400 invalid command, invalid arguments")
+    listing = price_book.quote(ticker)
+    if listing is None:
+        if price_book:
+            raise TradeRejected(f"404 Unknown stock symbol {ticker}")
+        return ticker, "", limit_price
+    if buying and listing.price > limit_price:
+        raise TradeRejected(f"400 {listing.symbol} trades at ${format_usd(listing.price)}, "
+                            f"above your limit of ${format_usd(limit_price)}")
+    if not buying and listing.price < limit_price:
+        raise TradeRejected(f"400 {listing.symbol} trades at ${format_usd(listing.price)}, "
+                            f"below your limit of ${format_usd(limit_price)}")
+    return listing.symbol, listing.name, listing.price
+
+def index_symbol(symbol, name):
     """
-    # Extract relevant information from command_parts and cast to appropriate types
-    try:
-        ticker = command_parts[1]
-        stock_amount = float(command_parts[2])
-        stock_price = float(command_parts[3])
-        user_id = int(command_parts[4])
-    except IndexError:
-        return "400 invalid command, missing arguments"
-    except ValueError:
-        return "400 invalid command, invalid arguments"
-    except Exception as e:
-        return f"400 invalid command, an error occurred: {e}"
+    Add a listed or newly bought symbol to the LOOKUP index, in every worker.
+    """
+    if symbol_index.add(symbol, name) and shard is not None:
+        shard.notify_symbol(symbol, name)
 
-    # Check if the user exists
-    cursor.execute("SELECT COUNT(*) FROM Users WHERE ID = ?", (user_id,))
-    user_exists = cursor.fetchone()[0]
+def check_owner(user_id):
+    """
+    Raise TradeRejected if user_id is served by another worker.
 
-    if not user_exists:
-        return f"400 User {user_id} not found."
+    An order run here would bypass the owner's per-user lock and leave its
+    cached balance stale, so it is refused rather than applied out of order.
+    """
+    if shard is not None and not shard.owns(user_id):
+        raise TradeRejected(f"403 Orders for user {user_id} are handled by another worker; "
+                            f"log in as that user to trade for it.")
 
-    # Check if the user has the specified amount of stock to sell
-    cursor.execute("SELECT stock_balance FROM Stocks WHERE user_id = ? AND stock_symbol = ?", (user_id, ticker))
-    existing_stock_balance = cursor.fetchone()
+def publish_change(user_id, changes):
+    """
+    Push committed (key, balance) changes of user_id to its subscribers, in every
+    worker; key is "USD" for a balance in cents or a stock symbol for one in
+    micro-shares.
+    """
+    subscriptions.publish(user_id, changes)
+    if shard is not None:
+        shard.notify_change(user_id, changes)
 
-    if existing_stock_balance is None or existing_stock_balance[0] < stock_amount:
-        return f"400 insufficient stock balance for {ticker}"
+def announce_subscribers(active):
+    """
+    Tell the other workers whether balance changes need to be sent to this one.
+    """
+    if shard is not None:
+        shard.notify_watching(active)
 
-    # Fetch user's balance
-    cursor.execute("SELECT usd_balance FROM Users WHERE ID = ?", (user_id,))
-    user_balance = cursor.fetchone()[0]
+@dispatcher.command("BUY", arguments=(str, parse_shares, parse_usd, int))
+def process_buy_command(conn, cursor, request):
+    """
+    Process the 'BUY' command to buy stocks.
+    """
+    ticker, stock_amount, limit_price, user_id = request.args
 
-    # Calculate the total amount to be received from selling the stocks
-    total_amount = stock_amount * stock_price
+    # Trade at the listed price, which must not be above the client's limit
+    try:
+        check_owner(user_id)
+        ticker, stock_name, stock_price = price_order(ticker, limit_price, buying=True)
+    except TradeRejected as e:
+        return str(e)
+
+    # Hold the user's lock so their orders are checked and applied one at a time, in order
+    with user_locks.lock(user_id):
+        # Reject early if the cached balance already shows the user cannot pay
+        user = balance_cache.peek_user(user_id)
+        if user is not None and user[4] < order_value(stock_amount, stock_price):
+            return "400 insufficient funds"
+
+        # Deduct the cost and add the stock in one transaction
+        try:
+            updated_stock_balance, new_balance = run_trade(conn, apply_buy, user_id, ticker, stock_amount, stock_price,
+                                                           stock_name)
+        except TradeRejected as e:
+            return str(e)
+        balance_cache.invalidate(user_id)
+        publish_change(user_id, [("USD", new_balance), (ticker, updated_stock_balance)])
+    index_symbol(ticker, stock_name)
 
-    # Update user's balance and stock balance
-    new_balance = user_balance + total_amount
-    updated_stock_balance = existing_stock_balance[0] - stock_amount
+    # Generate appropriate response
+    response = (f"200 OK\nBOUGHT: New balance: {format_shares(updated_stock_balance)} {ticker}. "
+                f"USD balance ${format_usd(new_balance)}")
+    return response
 
-    # Update user's balance and stock balance in the database
-    cursor.execute("UPDATE Users SET usd_balance = ? WHERE ID = ?", (new_balance, user_id))
-    cursor.execute("UPDATE Stocks SET stock_balance = ? WHERE user_id = ? AND stock_symbol = ?",
-                   (updated_stock_balance, user_id, ticker))
+@dispatcher.command("SELL", arguments=(str, parse_shares, parse_usd, int))
+def process_sell_command(conn, cursor, request):
+    """
+    Process the 'SELL' command to sell stocks.
+    """
+    ticker, stock_amount, limit_price, user_id = request.args
 
-    # Commit the transaction
-    conn.commit()
+    # Trade at the listed price, which must not be below the client's limit
+    try:
+        check_owner(user_id)
+        ticker, _, stock_price = price_order(ticker, limit_price, buying=False)
+    except TradeRejected as e:
+        return str(e)
+
+    # Hold the user's lock so their orders are checked and applied one at a time, in order
+    with user_locks.lock(user_id):
+        # Reject early if the cached holdings already show the user does not have the stock
+        holdings = balance_cache.peek_holdings(user_id)
+        if holdings is not None and not any(stock[1] == ticker and stock[3] >= stock_amount for stock in holdings):
+            return f"400 insufficient stock balance for {ticker}"
+
+        # Remove the stock and credit the proceeds in one transaction
+        try:
+            updated_stock_balance, new_balance = run_trade(conn, apply_sell, user_id, ticker, stock_amount, stock_price)
+        except TradeRejected as e:
+            return str(e)
+        balance_cache.invalidate(user_id)
+        publish_change(user_id, [("USD", new_balance), (ticker, updated_stock_balance)])
 
     # Generate appropriate response
-    response = f"200 OK\nSOLD: New balance: {updated_stock_balance} {ticker}. USD balance ${new_balance}"
+    response = (f"200 OK\nSOLD: New balance: {format_shares(updated_stock_balance)} {ticker}. "
+                f"USD balance ${format_usd(new_balance)}")
     return response
 
-def list_records(user_id, is_root, cursor):
+def parse_batch_legs(arguments):
+    """
+    Parse the '<BUY|SELL> <stock_symbol> <amount> <price> ...' legs of a BATCH order.
+
+    Returns a one-element tuple holding the list of (side, ticker, amount, price)
+    legs, with amounts in micro-shares and prices in cents.
+    Raises ValueError if the legs are malformed.
+    """
+    if not arguments or len(arguments) % 4 or len(arguments) // 4 > MAX_BATCH_LEGS:
+        raise ValueError(f"expected 1 to {MAX_BATCH_LEGS} legs of <BUY|SELL> <stock_symbol> <amount> <price>")
+    legs = []
+    for start in range(0, len(arguments), 4):
+        side, ticker, stock_amount, limit_price = arguments[start:start + 4]
+        side = side.upper()
+        if side not in ("BUY", "SELL"):
+            raise ValueError(f"invalid side: {side}")
+        legs.append((side, ticker, parse_shares(stock_amount), parse_usd(limit_price)))
+    return (legs,)
+
+@dispatcher.command("BATCH", arguments=(int,), optional=parse_batch_legs)
+def process_batch_command(conn, cursor, request):
+    """
+    Process the 'BATCH' command to buy and sell several stocks in one transaction.
+    """
+    user_id, legs = request.args
+
+    # Orders are only placed for the logged in user's own account
+    if user_id != request.user_id:
+        return "403 Access denied: BATCH orders can only be placed for your own account."
+
+    def rejected(failed_leg, reason):
+        # One line per leg: checked before the failed one, skipped after it
+        lines = ["400 batch rejected, no legs applied"]
+        for index, (side, ticker, stock_amount, _) in enumerate(legs):
+            status = "checked" if index < failed_leg else reason if index == failed_leg else "skipped"
+            lines.append(f"{index + 1} {side} {format_shares(stock_amount)} {ticker} {status}")
+        return "\n".join(lines) + "\n"
+
+    # Price every leg at the listed price, within the client's limit
+    priced_legs = []
+    for index, (side, ticker, stock_amount, limit_price) in enumerate(legs):
+        try:
+            ticker, stock_name, stock_price = price_order(ticker, limit_price, buying=side == "BUY")
+        except TradeRejected as e:
+            return rejected(index, str(e))
+        priced_legs.append((side, ticker, stock_amount, stock_price, stock_name))
+
+    # Hold the user's lock so the whole order is applied between the user's other orders
+    with user_locks.lock(user_id):
+        try:
+            leg_balances, new_balance = run_trade(conn, apply_batch, user_id, priced_legs)
+        except LegRejected as e:
+            return rejected(e.leg, str(e))
+        except TradeRejected as e:
+            return str(e)
+        balance_cache.invalidate(user_id)
+        # The last leg of each symbol holds its final balance
+        final_balances = {leg[1]: stock_balance for leg, stock_balance in zip(priced_legs, leg_balances)}
+        publish_change(user_id, [("USD", new_balance)] + list(final_balances.items()))
+    for side, ticker, _, _, stock_name in priced_legs:
+        if side == "BUY":
+            index_symbol(ticker, stock_name)
+
+    # Generate one result line per leg
+    lines = ["200 OK", f"BATCH: {len(legs)} legs applied. USD balance ${format_usd(new_balance)}"]
+    for index, ((side, ticker, stock_amount, stock_price, _), stock_balance) in enumerate(zip(priced_legs, leg_balances)):
+        action = "BOUGHT" if side == "BUY" else "SOLD"
+        lines.append(f"{index + 1} {action} {format_shares(stock_amount)} {ticker} at ${format_usd(stock_price)}. "
+                     f"New balance: {format_shares(stock_balance)} {ticker}")
+    return "\n".join(lines) + "\n"
+
+def parse_page_arguments(arguments):
+    """
+    Parse the optional '[<limit> [AFTER <id>]]' pagination arguments.
+
+    Returns a tuple of (limit, after_id) where limit is None if all rows are wanted.
+    Raises ValueError if the arguments are malformed.
+    """
+    if not arguments:
+        return None, 0
+    limit = int(arguments[0])
+    if limit <= 0:
+        raise ValueError(f"invalid page size: {limit}")
+    if len(arguments) == 1:
+        return limit, 0
+    if len(arguments) == 3 and arguments[1].upper() == "AFTER":
+        return limit, int(arguments[2])
+    raise ValueError("expected [<limit> [AFTER <id>]]")
+
+def parse_lookup_arguments(arguments):
     """
-    List records from the database
+    Parse the arguments after the first word of a LOOKUP: further words of the
+    search text, then the optional '[<limit> [AFTER <id>]]' paging arguments.
 
-.
+    Trailing words are only taken as paging arguments when the limit is
+    numeric, so 'LOOKUP Apple Inc' searches for 'Apple Inc'.
+    Returns the further search words followed by limit and after_id.
+    Raises ValueError if the paging arguments are malformed.
     """
-    if is_root:
-        return process_list_command(user_id=1, cursor=cursor)  # Assuming root user ID is 1
+    if len(arguments) >= 3 and arguments[-2].upper() == "AFTER" and arguments[-3].isdigit():
+        paging = arguments[-3:]
+    elif arguments and arguments[-1].isdigit():
+        paging = arguments[-1:]
     else:
-        return process_list_command(user_id=user_id, cursor=cursor)
+        paging = ()
+    return tuple(arguments[:len(arguments) - len(paging)]) + parse_page_arguments(paging)
+
+def fetch_next_rows(cursor):
+    """
+    Return a function that fetches the next chunk of rows from cursor.
+    """
+    return lambda: cursor.fetchmany(STREAM_CHUNK_ROWS)
+
+def load_user_row(cursor, user_id):
+    """
+    Return the (ID, first_name, last_name, user_name, usd_balance) row of user_id through the cache.
+    """
+    def load():
+        cursor.execute("SELECT ID, first_name, last_name, user_name, usd_balance FROM Users WHERE ID = ?",
+                       (user_id,))
+        return cursor.fetchone()
+    return balance_cache.get_user(user_id, load)
+
+def load_holdings(cursor, user_id):
+    """
+    Return the Stocks rows of user_id, in ID order, through the cache.
+    """
+    def load():
+        cursor.execute('''
+            SELECT Stocks.ID, Stocks.stock_symbol, Stocks.stock_name, Stocks.stock_balance,
+                   Users.first_name, Users.last_name
+            FROM Stocks
+            JOIN Users ON Users.ID = Stocks.user_id
+            WHERE Stocks.user_id = ?
+            ORDER BY Stocks.ID
+        ''', (user_id,))
+        return tuple(cursor.fetchall())
+    return balance_cache.get_holdings(user_id, load)
 
-def process_list_command(user_id, cursor):
+def stream_rows(header, first_rows, next_rows, format_row, limit):
+    """
+    Yield a response made of header and one line per row, in chunks.
+
+    After first_rows, further chunks are pulled by calling next_rows() until it
+    returns no rows, so memory use does not grow with the size of the result.
+    The first column of every row must be its ID; when a full page of limit
+    rows was sent, a final 'MORE AFTER <id>' line tells the client where the
+    next page starts.
+    """
+    chunk = [header]
+    rows = first_rows
+    count = 0
+    last_id = None
+    while rows:
+        chunk.extend(map(format_row, rows))
+        count += len(rows)
+        last_id = rows[-1][0]
+        yield "".join(chunk)
+        chunk = []
+        rows = next_rows()
+
+    if limit is not None and count == limit:
+        yield f"MORE AFTER {last_id}\n"
+
+@dispatcher.command("LIST", optional=parse_page_arguments)
+def process_list_command(conn, cursor, request):
     """
     Process the 'LIST' command to list all stocks.
     """
-    # Fetch all records from the Stocks table
+    user_id = request.user_id
+    limit, after_id = request.args
+
+    # Fetch the records from the Stocks table in ID order, starting after after_id
     if user_id == root_user_id:
         # If the user is root, fetch stock data with user names for all users
         cursor.execute('''
@@ -222,80 +465,85 @@ def process_list_command(user_id, cursor):
                    Users.first_name, Users.last_name, Users.user_name
             FROM Stocks
             JOIN Users ON Users.ID = Stocks.user_id
-        ''')
+            WHERE Stocks.ID > ?
+            ORDER BY Stocks.ID
+            LIMIT ?
+        ''', (after_id, limit or -1))
+        first_rows = cursor.fetchmany(STREAM_CHUNK_ROWS)
+        next_rows = fetch_next_rows(cursor)
     else:
         # If the user is not root, fetch only the stock data pertaining to the user
-        cursor.execute('''
-            SELECT Stocks.ID, Stocks.stock_symbol, Stocks.stock_name, Stocks.stock_balance,
-                   Users.first_name, Users.last_name
-            FROM Stocks
-            JOIN Users ON Users.ID = Stocks.user_id
-            WHERE Stocks.user_id = ?
-        ''', (user_id,))
-    stocks_data = cursor.fetchall()
+        holdings = load_holdings(cursor, user_id)
+        first_rows = [stock for stock in holdings if stock[0] > after_id][:limit]
+        next_rows = list
 
-    if not stocks_data:
+    if not first_rows:
         return "No records found in the Stocks database."
 
-    # Generate the response message with the list of records
-    response = "200 OK\n"
-    for stock in stocks_data:
-        if user_id == root_user_id:
+    # Stream the response message with the list of records
+    if user_id == root_user_id:
+        def format_row(stock):
             user_full_name = f"{stock[4]} {stock[5]}" if stock[4] and stock[5] else "Unknown User"
-            response += f"{stock[0]} {stock[1]} {stock[3]} {user_full_name} {stock[6]}\n"
-        else:
-            response += f"{stock[0]} {stock[1]} {stock[3]}\n"
+            return f"{stock[0]} {stock[1]} {format_shares(stock[3])} {user_full_name} {stock[6]}\n"
+    else:
+        def format_row(stock):
+            return f"{stock[0]} {stock[1]} {format_shares(stock[3])}\n"
 
-    return response
+    return stream_rows("200 OK\n", first_rows, next_rows, format_row, limit)
 
-def process_balance_command(user_id, cursor):
+@dispatcher.command("BALANCE", optional=parse_page_arguments)
+def process_balance_command(conn, cursor, request):
     """
     Process the 'BALANCE' command to display user balances.
     """
-    # Fetch all records from the Users table
+    user_id = request.user_id
+    limit, after_id = request.args
+
+    # Fetch the records from the Users table in ID order, starting after after_id
     if user_id == root_user_id:
-        cursor.execute("SELECT * FROM Users")
+        cursor.execute("SELECT ID, first_name, last_name, user_name, usd_balance FROM Users "
+                       "WHERE ID > ? ORDER BY ID LIMIT ?", (after_id, limit or -1))
+        first_rows = cursor.fetchmany(STREAM_CHUNK_ROWS)
+        next_rows = fetch_next_rows(cursor)
     else:
-        cursor.execute("SELECT * FROM Users WHERE ID = ?", (user_id,))
-    users_data = cursor.fetchall()
+        # Other users only see their own row, which is served from the cache
+        user = load_user_row(cursor, user_id)
+        first_rows = [user] if user is not None and user[0] > after_id else []
+        next_rows = list
 
-    if not users_data:
+    if not first_rows:
         return "No records found in the Users database."
 
-    # Generate the response message with the balance for each user
-    response = "200 OK\n"
-    for user in users_data:
-        balance = user[5]  # The USD balance is stored in the sixth column (index 5)
+    # Stream the response message with the balance for each user
+    def format_row(user):
         if(not user[1] or  not user[2]):
             full_name = user[3]
         else:
             full_name = f"{user[1]} {user[2]}"
+        return f"Balance for user {full_name}: ${format_usd(user[4])}\n"
 
-        response += f"Balance for user {full_name}: ${balance}\n"
-
-    return response
+    return stream_rows("200 OK\n", first_rows, next_rows, format_row, limit)
 
-def process_login_command(user_name, password, client_address):
+@dispatcher.command("LOGIN", arguments=(str, str), login_required=False, logged_out_only=True)
+def process_login_command(conn, cursor, request):
     """
     Process the 'LOGIN' command to log in users.
     """
+    user_name, password = request.args
     try:
-        with sqlite3.connect('database.db') as conn:
-            cursor = conn.cursor()
-            # Select the user with a matching username and password
-            cursor.execute("SELECT * FROM Users WHERE user_name = ? AND password = ?", (user_name, password))
-            user = cursor.fetchone()
-            if user:
-                # Correct login
-                user_id = user[0]
-                cursor.execute("INSERT INTO ActiveUsers (user_id, user_name, ip_address, port) VALUES (?, ?, ?, ?)",
-                                (user_id, user_name, client_address[0], client_address[1]))
-                return "200 OK", user_id  # Return the user ID as well for future commands
-            else:
-                # Incorrect login
-                return "403 Wrong UserID or Password", None
+        # Select the user with a matching username and password
+        cursor.execute("SELECT ID FROM Users WHERE user_name = ? AND password = ?", (user_name, password))
+        user = cursor.fetchone()
+        if user:
+            # Correct login; remember the user ID for future commands
+            request.user_id = user[0]
+            active_sessions.login(request.client_address, request.user_id, user_name)
+            return "200 OK"
+        else:
+            # Incorrect login
+            return "403 Wrong UserID or Password"
     except Exception as e:
-        return f"500 Internal Server Error: {e}", None
+        return f"500 Internal Server Error: {e}"
     
 def process_help_command(user_id=None, invalid_command=None):
     """
@@ -319,26 +567,30 @@ def process_help_command(user_id=None, invalid_command=None):
         help_message = """
         Available Commands:
     - LOGIN <user_name> <password>: Log in with your username and password.
-    - BUY <stock_symbol> <amount> <price> <user_id>: Buy stocks with the specified amount, price, and user ID.
-    - SELL <stock_symbol> <amount> <price> <user_id>: Sell stocks with the specified amount, price, and user ID.
-    - LIST [<user_id>]: List all stocks. If no user ID is provided, list all stocks for the logged-in user.
-    - BALANCE [<user_id>]: Display the balance. If no user ID is provided, display the balance for the logged-in user.
-    - LOOKUP <stock_name>: Search for stocks by name.
+    - BUY <stock_symbol> <amount> <price> <user_id>: Buy stocks at the listed price, if it is at most <price>.
+    - SELL <stock_symbol> <amount> <price> <user_id>: Sell stocks at the listed price, if it is at least <price>.
+    - BATCH <user_id> <BUY|SELL> <stock_symbol> <amount> <price> ...: Apply several buys and sells for your account all at once or not at all.
+    - LIST [<limit> [AFTER <id>]]: List your stocks (all stocks for root), optionally one page at a time.
+    - BALANCE [<limit> [AFTER <id>]]: Display your balance (all balances for root), optionally one page at a time.
+    - LOOKUP <stock_name> [<limit> [AFTER <id>]]: Search for stocks by name, which may be several words, optionally one page at a time.
+    - QUOTE <stock_symbol>: Display the listed price of a stock.
+    - PRICE <stock_symbol> <price> [<name>]: Set the listed price of a stock (root user only).
     - DEPOSIT <amount>: Deposit funds into your account.
     - LOGOUT: Log out from the system.
     - WHO: Display active users (root user only).
     - HELP: Display this help message.
     - QUIT: Terminate the connection.
+    - SUBSCRIBE: Receive your balance and holdings changes as they happen (every user's for root).
+    - UNSUBSCRIBE: Stop receiving changes.
+    - STATS: Display server metrics (root user only).
     - SHUTDOWN: Shutdown the server (root user only).
         """
 
     if invalid_command:
-        # Check if the invalid command is partially correct to provide suggestions
+        # Check if the invalid command is partially correct to provide suggestions,
+        # from the registered commands so the list cannot drift from the dispatcher
         suggestions = []
-        available_commands = [
-            "LOGIN", "BUY", "SELL", "LIST", "BALANCE", "LOOKUP", "DEPOSIT", "LOGOUT", "WHO", "HELP", "QUIT", "SHUTDOWN"
-        ]
-        for command in available_commands:
+        for command in dispatcher.names():
             if command.startswith(invalid_command.upper()):
                 suggestions.append(command)
         
@@ -347,271 +599,701 @@ def process_help_command(user_id=None, invalid_command=None):
 
     return help_message
 
-def handle_shutdown_command(user_id, cursor):
+@dispatcher.command("HELP", optional=tuple, login_required=False)
+def run_help_command(conn, cursor, request):
+    """
+    Process the 'HELP' command. 'HELP <partial command>' suggests matching commands.
+    """
+    return process_help_command(request.user_id, request.args[0] if request.args else None)
+
+@dispatcher.command("SHUTDOWN")
+def handle_shutdown_command(conn, cursor, request):
     """
     Process the 'SHUTDOWN' command to shutdown the server.
     """
+    user_id = request.user_id
+    # The connection is closed whether or not the shutdown is allowed
+    request.close_connection = True
+
     # Check if the user is root
     cursor.execute("SELECT ID FROM Users WHERE user_name = 'Root'")
     root_user_row = cursor.fetchone()
     if root_user_row is not None:
         root_user_id = root_user_row[0]
         if user_id == root_user_id:
-            print("Server shutdown initiated. All connected clients will be terminated.")
-            # Terminate server process abruptly
-            os._exit(0)  # This will terminate the server process instantly and abruptly
+            logger.info("Server shutdown initiated. All connected clients will be disconnected.")
+            if shard is not None:
+                # Let the supervisor stop every worker
+                shard.request_shutdown()
+            else:
+                # main() drains the connections and flushes pending trades
+                stop_server()
+            return "200 OK"
         else:
             return "Error: Only the root user has the authority to execute a server shutdown."
     else:
         return "Error: Root user not found."
 
-def process_logout_command(cursor, user_id):
+@dispatcher.command("LOGOUT")
+def process_logout_command(conn, cursor, request):
     """
     Process the 'LOGOUT' command to log out users.
     """
-    # Delete the user from the ActiveUsers table
-    cursor.execute("DELETE FROM ActiveUsers WHERE user_id = ?", (user_id,))
+    # Forget the client's session and close the connection
+    active_sessions.logout(request.client_address)
+    request.close_connection = True
     return "200 OK"
 
-def process_who_command(cursor, user_id):
+@dispatcher.command("QUIT", login_required=False)
+def process_quit_command(conn, cursor, request):
     """
-    Process the 'WHO' command to display active users.
+    Process the 'QUIT' command to close the connection.
     """
-    # Check if the user is root
-    if user_id != root_user_id:  # Assuming root user ID is 5
-        return "403 Access denied: WHO command is only allowed for the root user."
+    request.close_connection = True
+    return "200 OK"
 
-    # Fetch active users from the database
-    cursor.execute("SELECT user_name, ip_address FROM ActiveUsers")
-    active_users = cursor.fetchall()
+@dispatcher.command("WHO", root_only=True)
+def process_who_command(conn, cursor, request):
+    """
+    Process the 'WHO' command to display active users.
+    """
+    # Fetch active users from the session registry
+    active_users = active_sessions.sessions()
 
     if not active_users:
         return "No active users found."
 
     # Generate the response message with the list of active users
-    response = "200 OK\nThe list of active users:\n"
-    # Clear previous list
-    for user in active_users:
-        response += f"{user[0]} {user[1]}\n"
+    lines = ["200 OK", "The list of active users:"]
+    lines.extend(f"{session.user_name} {session.ip_address}" for session in active_users)
+    return "\n".join(lines) + "\n"
 
-    return response
+@dispatcher.command("SUBSCRIBE")
+def process_subscribe_command(conn, cursor, request):
+    """
+    Process the 'SUBSCRIBE' command to be sent balance and holdings changes as they commit.
+    """
+    user_id = request.user_id
+    if request.sender is None:
+        return "400 SUBSCRIBE is not supported on this connection"
 
-def process_lookup_command(user_id, cursor, command_parts):
+    # Root watches every user; updates arrive as further responses to this request
+    subscriptions.subscribe(request.client_address, ALL_USERS if user_id == root_user_id else user_id, request.sender)
+    if user_id == root_user_id:
+        return "200 OK\nSUBSCRIBED: all users\n"
+
+    # Start the client off with the current balances, which later updates replace.
+    # Subscribing first means a change committed meanwhile is still pushed.
+    user = load_user_row(cursor, user_id)
+    lines = ["200 OK", f"SUBSCRIBED: user {user_id}"]
+    if user is not None:
+        lines.append(f"UPDATE {user_id} USD {format_usd(user[4])}")
+    lines.extend(f"UPDATE {user_id} {stock[1]} {format_shares(stock[3])}" for stock in load_holdings(cursor, user_id))
+    return "\n".join(lines) + "\n"
+
+@dispatcher.command("UNSUBSCRIBE")
+def process_unsubscribe_command(conn, cursor, request):
     """
-    Process the 'LOOKUP' command to search for stocks.
+    Process the 'UNSUBSCRIBE' command to stop the updates started by SUBSCRIBE.
     """
-    # Extract relevant information from command_parts
-    try:
-        stock_name = command_parts[1]
-    except IndexError:
-        return "400 invalid command, missing arguments"
+    if not subscriptions.unsubscribe(request.client_address):
+        return "400 not subscribed"
+    return "200 OK"
 
-    if user_id == root_user_id:  # Assuming root user ID is 1
-        cursor.execute('''
-            SELECT stock_symbol, stock_balance, user_name
-            FROM Stocks
-            JOIN Users ON Users.ID = Stocks.user_id
-            WHERE stock_name LIKE ? OR stock_symbol LIKE ?
-        ''', ('%' + stock_name + '%', '%' + stock_name + '%'))
+@dispatcher.command("STATS", root_only=True)
+def process_stats_command(conn, cursor, request):
+    """
+    Process the 'STATS' command to display the server metrics.
+    """
+    return "200 OK\n" + server_metrics.format_snapshot()
 
-        matched_stocks = cursor.fetchall()
+@dispatcher.command("QUOTE", arguments=(str,))
+def process_quote_command(conn, cursor, request):
+    """
+    Process the 'QUOTE' command to show the listed price of a stock.
+    """
+    symbol, = request.args
+    listing = price_book.quote(symbol)
+    if listing is None:
+        return f"404 Unknown stock symbol {symbol}"
+    return f"200 OK\n{listing.symbol} {listing.name}: ${format_usd(listing.price)}"
+
+@dispatcher.command("PRICE", arguments=(str, parse_usd), optional=tuple, root_only=True)
+def process_price_command(conn, cursor, request):
+    """
+    Process the 'PRICE' command to set the price of a stock, listing it if it is new.
+    """
+    symbol, price = request.args[:2]
+    name = " ".join(request.args[2:]) or None
+    try:
+        listing = price_book.update(symbol, price, name)
+    except ValueError as e:
+        return f"400 {e}"
+    if shard is not None:
+        shard.notify_price(listing.symbol, listing.price, listing.name)
+    index_symbol(listing.symbol, listing.name)
+    return f"200 OK\nPRICE: {listing.symbol} {listing.name}: ${format_usd(listing.price)}"
+
+@dispatcher.command("LOOKUP", arguments=(str,), optional=parse_lookup_arguments)
+def process_lookup_command(conn, cursor, request):
+    """
+    Process the 'LOOKUP' command to search for stocks.
+    """
+    user_id = request.user_id
+    *words, limit, after_id = request.args
+    stock_name = " ".join(words)
 
-        # Generate the response message with the list of matched records
-        response = f"200 OK\nFound {len(matched_stocks)} match{'es' if len(matched_stocks) > 1 else ''} for '{stock_name}':\n"
-        for stock in matched_stocks:
-            response += f"{stock[0]} {stock[1]} {stock[2]}\n"
-    else:
-        # Search for the stock records matching the given name
-        cursor.execute('''
-            SELECT stock_symbol, stock_balance
-            FROM Stocks
-            JOIN Users ON Users.ID = Stocks.user_id
-            WHERE (stock_name LIKE ? OR stock_symbol LIKE ?) AND user_id = ?
-        ''', ('%' + stock_name + '%', '%' + stock_name + '%', user_id))
+    # Find the symbols whose symbol or name contains the search text, so only their holdings are read
+    symbols = symbol_index.search(stock_name)
+    if not symbols:
+        return f"404 Your search for '{stock_name}' did not match any records."
 
-        matched_stocks = cursor.fetchall()
+    # Build the search condition, limited to the user's own stocks unless root
+    condition = "stock_symbol IN (SELECT value FROM json_each(?))"
+    parameters = (json.dumps(symbols),)
+    if user_id != root_user_id:  # Assuming root user ID is 1
+        condition += " AND user_id = ?"
+        parameters += (user_id,)
 
-        # Generate the response message with the list of matched records
-        response = f"200 OK\nFound {len(matched_stocks)} match{'es' if len(matched_stocks) > 1 else ''} for '{stock_name}':\n"
-        for stock in matched_stocks:
-            response += f"{stock[0]} {stock[1]}\n"
+    # Count all matches for the header, then stream the requested page
+    cursor.execute(f"SELECT COUNT(*) FROM Stocks JOIN Users ON Users.ID = Stocks.user_id WHERE {condition}",
+                   parameters)
+    match_count = cursor.fetchone()[0]
 
-    if not matched_stocks:
+    if not match_count:
         return f"404 Your search for '{stock_name}' did not match any records."
 
-    return response
+    cursor.execute(f'''
+        SELECT Stocks.ID, stock_symbol, stock_balance, user_name
+        FROM Stocks
+        JOIN Users ON Users.ID = Stocks.user_id
+        WHERE {condition} AND Stocks.ID > ?
+        ORDER BY Stocks.ID
+        LIMIT ?
+    ''', parameters + (after_id, limit or -1))
+    first_rows = cursor.fetchmany(STREAM_CHUNK_ROWS)
+
+    # Stream the response message with the list of matched records
+    header = f"200 OK\nFound {match_count} match{'es' if match_count > 1 else ''} for '{stock_name}':\n"
+    if user_id == root_user_id:
+        def format_row(stock):
+            return f"{stock[1]} {format_shares(stock[2])} {stock[3]}\n"
+    else:
+        def format_row(stock):
+            return f"{stock[1]} {format_shares(stock[2])}\n"
 
-def process_deposit_command(conn, cursor, command_parts, client_address):
+    return stream_rows(header, first_rows, fetch_next_rows(cursor), format_row, limit)
+
+@dispatcher.command("DEPOSIT", arguments=(parse_usd,))
+def process_deposit_command(conn, cursor, request):
     """
     Process the 'DEPOSIT' command to deposit funds into a user's account.
     """
-    try:
-        amount = float(command_parts[1])
-    except (IndexError, ValueError):
-        return "400 invalid command, missing or invalid amount"
+    amount, = request.args
+    user_id = request.user_id
+
+    # Apply the user's deposits one at a time, in the order they arrived
+    with user_locks.lock(user_id):
+        # Add the amount to the user's balance in one transaction
+        try:
+            new_balance = run_trade(conn, apply_deposit, user_id, amount)
+        except TradeRejected as e:
+            return str(e)
+        balance_cache.invalidate(user_id)
+        publish_change(user_id, [("USD", new_balance)])
 
-    # Fetch user_id from ActiveUsers table based on the client's IP address
-    cursor.execute("SELECT user_id FROM ActiveUsers WHERE ip_address = ? AND port = ?", (client_address[0], client_address[1]))
-    user_data = cursor.fetchone()
+    # Generate appropriate response
+    response = f"200 OK\nDEPOSIT: New balance: ${format_usd(new_balance)}"
+    return response
 
-    if not user_data:
-        return "403 not logged in, please login first"
+def register_client(client_address):
+    """
+    Count a newly accepted client connection.
+    """
+    server_metrics.increment("connections_accepted")
+    logger.debug("connection accepted client=%s:%s", client_address[0], client_address[1])
 
-    user_id = user_data[0]
+def cleanup_client(client_address):
+    """
+    Forget the session of a disconnected client.
+    """
+    server_metrics.increment("connections_closed")
+    active_sessions.logout(client_address)
+    subscriptions.unsubscribe(client_address)
 
-    # Fetch user's balance
-    cursor.execute("SELECT usd_balance FROM Users WHERE ID = ?", (user_id,))
-    user_balance = cursor.fetchone()[0]
+def guard_stream(chunks, on_error):
+    """
+    Yield the chunks of a streamed response, ending it with the line returned
+    by on_error() if producing the next chunk fails.
+    """
+    try:
+        yield from chunks
+    except Exception:
+        yield on_error() + "\n"
 
-    # Update the user's balance
-    new_balance = user_balance + amount
-    cursor.execute("UPDATE Users SET usd_balance = ? WHERE ID = ?", (new_balance, user_id))
+def run_command(request_id, command_parts, user_id, client_address, send, open_sender=None):
+    """
+    Run a single command on a connection borrowed from the pool and send its response.
 
-    # Commit the transaction
-    conn.commit()
+    Connections are only held while a command runs, so idle clients do not
+    keep one open. The response frames are passed to send() before the
+    connection is returned, since streamed responses read rows as they go.
+    open_sender(request_id), if given, returns the subscriptions sender that
+    lets the command push later responses to the same request, as SUBSCRIBE does.
 
-    # Generate appropriate response
-    response = f"200 OK\nDEPOSIT: New balance: ${new_balance}"
-    return response
+    A command that raises, for instance because the database stayed locked,
+    is logged and answered with a 500 so the connection stays usable.
 
-def handle_client(client_socket, client_address):
+    Returns a tuple of (user_id, close_connection).
+    """
+    started = time.perf_counter()
+    socket_time = 0.0
+    status = None
+    sender = open_sender(request_id) if open_sender is not None else None
+
+    def internal_error():
+        # Called while the handler's exception is being handled, so it is logged with its traceback
+        logger.exception("command failed client=%s:%s id=%s command=%s", client_address[0], client_address[1],
+                         request_id, command_parts[0] if command_parts else None)
+        return INTERNAL_ERROR
+
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            try:
+                response, user_id, close_connection = dispatcher.dispatch(conn, cursor, command_parts, user_id,
+                                                                          client_address, sender)
+            except Exception:
+                response, close_connection = internal_error(), False
+            if not isinstance(response, str):
+                # Rows are read while the response is sent, so a failure can still happen part way
+                response = guard_stream(response, internal_error)
+            for frame in iter_response_frames(request_id, response):
+                if status is None:
+                    status = frame_status(frame)
+                sending = time.perf_counter()
+                send(frame)
+                socket_time += time.perf_counter() - sending
+        finally:
+            cursor.close()
+    elapsed = time.perf_counter() - started
+
+    # Unknown commands share one name so clients cannot grow the metrics without bound
+    command = command_parts[0] if command_parts and command_parts[0] in dispatcher else "UNKNOWN"
+    server_metrics.record(command, status, elapsed, socket_time)
+    if logger.isEnabledFor(logging.DEBUG) and (log_sample_rate >= 1.0 or random.random() < log_sample_rate):
+        logger.debug("request client=%s:%s id=%s command=%s status=%s user=%s ms=%.3f socket_ms=%.3f",
+                     client_address[0], client_address[1], request_id, command, status, user_id,
+                     elapsed * 1000, socket_time * 1000)
+    return user_id, close_connection
+
+def handle_client(client_socket, client_address, user_id=None, buffered=b""):
     """
     Handle client connections and requests.
+
+    A client handed over by another worker arrives already logged in as
+    user_id, with the request bytes that worker had read but not yet run.
     """
     global is_server_running
-    # Initialize the user_id as None to indicate that the client is not logged in
-    user_id = None
-    conn = sqlite3.connect('database.db')  # Create a new connection
-    cursor = conn.cursor()  # Create a new cursor
 
+    # Buffered reader so pipelined request lines are split correctly
+    reader = client_socket.makefile('rb')
+    if buffered:
+        reader = PrefixedReader(buffered, reader)
+
+    register_client(client_address)
+    connection = client_connections.add(client_socket, client_address)
+    client_connections.limit_output(client_socket, connection_limits)
+
+    def push_frames(frames):
+        # Called from a subscription's thread, between commands so responses are
+        # not split; a subscriber that stops reading is dropped like any slow client
+        with connection.lock:
+            try:
+                for frame in frames:
+                    send_within(client_socket, frame, connection_limits.send_timeout)
+            except TimeoutError:
+                server_metrics.increment("slow_clients_dropped")
+                logger.warning("dropping slow subscriber client=%s:%s", client_address[0], client_address[1])
+                client_connections.abort(client_socket)
+                try:
+                    # Wakes the handler blocked reading, which closes the connection
+                    client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                raise
+
+    def open_sender(request_id):
+        return thread_sender(lambda text: push_frames(iter_response_frames(request_id, text)))
     try:
-        print(f"[*] Accepted connection from {client_address[0]}:{client_address[1]}")
-
         # Handle client requests
         while True:
-            print("[*] Waiting for a command...")
-            data = client_socket.recv(1024).decode().strip()
-            if not data:
+            # A subscriber may only listen, so it is never reaped for being idle
+            client_socket.settimeout(None if subscriptions.is_subscribed(client_address)
+                                     else connection_limits.idle_timeout)
+            try:
+                line = reader.readline(MAX_REQUEST_LINE)
+            except TimeoutError:
+                # Reap the idle client so it does not hold a thread forever
+                server_metrics.increment("connections_reaped")
+                try:
+                    client_socket.settimeout(1.0)
+                    client_socket.sendall(IDLE_NOTICE)
+                except OSError:
+                    pass
                 break
-            print(f"[*] Received: {data}")
-
-            # Split the received data into command and arguments
-            command_parts = data.split()
-            print(f"[*] Command: {command_parts[0]}")
-
-            # Ensure the command is valid and has the correct format
-            if len(command_parts) < 1:
-                response = "403 message format error"
-            elif command_parts[0] == "HELP":
-                response = process_help_command(user_id)
-            elif user_id is None and command_parts[0] != "QUIT":
-                if command_parts[0] == "LOGIN":
-                    if len(command_parts) != 3:
-                        response = "400 invalid command, missing arguments"
-                    else:
-                        response, user_id = process_login_command(command_parts[1], command_parts[2], client_address)
-                else:
-                    response = process_help_command()
-            else:
-                command = command_parts[0]
-
-                if command == "BUY":
-                    if user_id is None:
-                        response = "403 not logged in, please login first"
-                    else:
-                        response = process_buy_command(conn, cursor, command_parts)  # Pass conn and cursor here
-                elif command == "SELL":
-                    if user_id is None:
-                        response = "403 not logged in, please login first"
-                    else:
-                        response = process_sell_command(conn, cursor, command_parts)  # Pass conn and cursor here
-                elif command == "LIST":
-                    if user_id is None:
-                        response = "403 not logged in, please login first"
-                    else:
-                        response = process_list_command(user_id, cursor)  # Pass cursor here
-                elif command == "BALANCE":
-                    if user_id is None:
-                        response = "403 not logged in, please login first"
-                    else:
-                        response = process_balance_command(user_id, cursor)  # Pass cursor here
-                elif command == "LOOKUP":
-                    if user_id is None:
-                        response = "403 not logged in, please login first"
-                    else:
-                        response = process_lookup_command(user_id, cursor, command_parts)
-                elif command == "DEPOSIT":
-                        response = process_deposit_command(conn, cursor, command_parts, client_address)  # Pass client_address here
-                elif command == "LOGOUT":
-                    response = process_logout_command(cursor, user_id)  # Pass cursor here
-                    client_socket.send(response.encode())
-                    # Remove the user from ActiveUsers table
-                    cursor.execute("DELETE FROM ActiveUsers WHERE user_id = ?", (user_id,))
-                    conn.commit()
-                    client_socket.close()
+            if not line:
+                break
+            # Hold the connection's lock while the command runs, so a shutdown
+            # only closes the connection between commands
+            with connection.lock:
+                if not is_server_running:
+                    break  # The server is draining; do not start new commands
+                if not line.endswith(b"\n") and len(line) >= MAX_REQUEST_LINE:
+                    # The rest of the stream cannot be framed any more, so give up on it
+                    client_socket.sendall(encode_response(UNKNOWN_REQUEST_ID, "400 request too long"))
+                    break
+                if not line.strip():
+                    continue  # Ignore blank lines
+
+                # Split the received line into request ID, command and arguments
+                try:
+                    request_id, command_parts = decode_request(line)
+                except ValueError:
+                    client_socket.sendall(encode_response(UNKNOWN_REQUEST_ID, "403 message format error"))
+                    continue
+
+                # Run the command and send the response back to the client, dropping
+                # a client that stops reading rather than holding the response for it
+                client_socket.settimeout(connection_limits.send_timeout)
+                try:
+                    user_id, close_connection = run_command(request_id, command_parts, user_id, client_address,
+                                                            client_socket.sendall, open_sender)
+                except TimeoutError:
+                    server_metrics.increment("slow_clients_dropped")
+                    logger.warning("dropping slow client=%s:%s", client_address[0], client_address[1])
+                    client_connections.abort(client_socket)
                     break
-                elif command == "WHO":
-                        if user_id is None:
-                            response = "403 not logged in, please login first"
-                        else:
-                            response = process_who_command(cursor, user_id)  # Pass cursor here
-
-                elif command == "HELP":
-                    response = process_help_command(user_id)
-                elif command == "QUIT":
-                    response = "200 OK"
-                    client_socket.send(response.encode())
+                if close_connection:
                     client_socket.close()
                     break
-                elif command == "SHUTDOWN":
-                    if user_id is None:
-                        response = "403 not logged in, please login first"
-                    else:
-                        response = handle_shutdown_command(user_id, cursor)  # Pass cursor here
-                        client_socket.send(response.encode())
-                        client_socket.close()
-                        break
-                else:
-                    response = "400 invalid command"
-                   
-
-            # Send the response back to the client
-            client_socket.send(response.encode())
+                if shard is not None and user_id is not None and not shard.owns(user_id):
+                    # Just logged in as a user served by another worker; move the connection there
+                    session = active_sessions.logout(client_address)
+                    shard.hand_off(client_socket, client_address, user_id, session.user_name,
+                                   buffered_bytes(client_socket, reader))
+                    break
 
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logger.warning("connection error client=%s:%s error=%s", client_address[0], client_address[1], e)
 
     finally:
-        # If the user is logged in and the client socket is still open, perform cleanup
-        if user_id is not None and not client_socket._closed:
-            # Remove the user from ActiveUsers table
-            cursor.execute("DELETE FROM ActiveUsers WHERE user_id = ?", (user_id,))
-            conn.commit()
-        # Close cursor and connection
-        cursor.close()
-        conn.close()
+        client_connections.remove(connection)
+        # Forget the session if the client went away while logged in
+        cleanup_client(client_address)
         # Close client socket
+        reader.close()
         client_socket.close()
 
-# Create a server socket
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.bind((SERVER_HOST, SERVER_PORT))
-server_socket.listen(10)
-print(f"[*] Listening on {SERVER_HOST}:{SERVER_PORT}")
+def adopt_client(client_socket, client_address, user_id, user_name, buffered):
+    """
+    Serve a logged in client handed over by another worker.
+    """
+    active_sessions.login(client_address, user_id, user_name)
+    handle_client(client_socket, client_address, user_id, buffered)
+
+def stop_server():
+    """
+    Stop accepting clients; main() then drains the open connections and exits.
+    """
+    global is_server_running
+    is_server_running = False
+    async_stop.set()
+    if listening_socket is not None:
+        try:
+            # Wakes up the accept() in the main thread
+            listening_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def open_listening_socket(host, port):
+    """
+    Create a socket listening on host:port; port 0 picks a free port.
+    """
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Allow quick restarts while old connections sit in TIME_WAIT
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind((host, port))
+    server_socket.listen(10)
+    return server_socket
+
+def run_threaded_server(host, port, server_socket=None):
+    """
+    Accept clients and serve each one on its own thread.
 
-# Accept multiple clients using threads
-while is_server_running:
+    Workers pass in the listening socket they inherited from the supervisor.
+    """
+    global is_server_running, listening_socket
+    if server_socket is None:
+        server_socket = open_listening_socket(host, port)
+    listening_socket = server_socket
+    logger.info("Listening on %s:%s", *server_socket.getsockname()[:2])
+
+    # Accept multiple clients using threads
+    while is_server_running:
+        try:
+            client_socket, client_address = server_socket.accept()
+            if len(client_connections) >= connection_limits.max_connections:
+                server_metrics.increment("connections_rejected")
+                client_connections.reject(client_socket)
+                continue
+            # Workers leave shutdown to the supervisor, so their clients must not keep them alive
+            client_thread = threading.Thread(target=handle_client, args=(client_socket, client_address),
+                                             daemon=shard is not None)
+            client_thread.start()
+            # Forget threads that have already finished so the list does not grow forever
+            client_threads[:] = [thread for thread in client_threads if thread.is_alive()]
+            client_threads.append(client_thread)  # Add the thread to the client_threads list
+        except KeyboardInterrupt:
+            logger.info("Interrupted by user, initiating server shutdown.")
+            break
+        except socket.error:
+            if not is_server_running:
+                break  # Break if socket error occurs due to shutdown
+
+    # Close server socket
+    server_socket.close()
+
+def build_parser():
+    """
+    Return the parser of the server's command line options.
+    """
+    parser = argparse.ArgumentParser(description="Stock trading server")
+    parser.add_argument("--host", default=SERVER_HOST, help="address to listen on")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help="port to listen on")
+    parser.add_argument("--db-path", default=DATABASE_PATH, help="SQLite database file, created if missing")
+    parser.add_argument("--mode", choices=("threaded", "async"), default="threaded",
+                        help="thread-per-connection or single asyncio event loop")
+    parser.add_argument("--db-workers", type=int, default=DB_WORKERS,
+                        help="size of the database executor used by the async mode")
+    parser.add_argument("--db-pool-size", type=int, default=DB_POOL_SIZE,
+                        help="maximum number of pooled SQLite connections")
+    parser.add_argument("--group-commit", action="store_true",
+                        help="commit trades and deposits in batches from a single writer thread")
+    parser.add_argument("--group-commit-batch", type=int, default=DEFAULT_MAX_BATCH,
+                        help="most operations committed together")
+    parser.add_argument("--group-commit-delay-ms", type=float, default=DEFAULT_MAX_DELAY * 1000,
+                        help="longest time an operation waits for its batch to fill")
+    parser.add_argument("--group-commit-synchronous", type=str.upper, choices=SYNCHRONOUS_LEVELS,
+                        default=DEFAULT_SYNCHRONOUS,
+                        help="SQLite synchronous level of the writer's commits (FULL survives a power loss)")
+    parser.add_argument("--snapshot-sessions", type=float, metavar="SECONDS",
+                        help="copy the logged in sessions into the ActiveUsers table this often")
+    parser.add_argument("--ledger-snapshot-interval", type=float, default=DEFAULT_SNAPSHOT_INTERVAL, metavar="SECONDS",
+                        help="snapshot all balances for ledger replay this often (0 disables)")
+    parser.add_argument("--prices", default=DEFAULT_PRICES_PATH, metavar="CSV",
+                        help="symbol,name,price snapshot loaded into the price book ('' trades at client prices)")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_ENTRIES,
+                        help="most balance and holdings entries kept in memory (0 disables the cache)")
+    parser.add_argument("--cache-ttl", type=float, default=DEFAULT_TTL,
+                        help="seconds a cached balance or holdings entry stays valid")
+    parser.add_argument("--lock-stripes", type=int, default=DEFAULT_STRIPES,
+                        help="number of locks the per-user order locks are spread over")
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="log level; DEBUG logs every connection and request")
+    parser.add_argument("--log-sample-rate", type=float, default=1.0,
+                        help="fraction of requests logged at DEBUG level")
+    parser.add_argument("--stats-interval", type=float, metavar="SECONDS",
+                        help="log the server metrics this often")
+    parser.add_argument("--drain-timeout", type=float, default=DRAIN_TIMEOUT,
+                        help="seconds a shutdown waits for running commands before closing their connections")
+    parser.add_argument("--idle-timeout", type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help="seconds before a client that sends nothing is disconnected (0 disables)")
+    parser.add_argument("--send-timeout", type=float, default=DEFAULT_SEND_TIMEOUT,
+                        help="seconds before a client that stops reading its response is disconnected (0 disables)")
+    parser.add_argument("--max-connections", type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help="most clients connected at once (per worker); more are turned away")
+    parser.add_argument("--max-output-buffer", type=int, default=DEFAULT_MAX_OUTPUT_BUFFER,
+                        help="bytes of response data buffered per client before the server waits for it to read")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, with users sharded over them by ID (threaded mode only)")
+    # Set by the supervisor when it starts a worker
+    parser.add_argument("--worker-index", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--listen-fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--inbox-fds", help=argparse.SUPPRESS)
+    return parser
+
+def configure(args):
+    """
+    Set up the state shared by the command handlers from the parsed options.
+
+    Opens the database, bringing its schema up to date, and loads the price
+    book and the symbol index. Importing this module does none of this, so a
+    server can be configured and started more than once in one process.
+    """
+    global is_server_running, db_pool, trade_writer, user_locks, connection_limits, client_connections
+    global active_sessions, balance_cache, subscriptions, price_book, symbol_index, log_sample_rate
+    global server_metrics, background_stop, background_threads
+    is_server_running = True
+    async_stop.clear()
+    server_metrics = create_metrics()
+    background_stop = threading.Event()
+    background_threads = []
+
+    db_pool = ConnectionPool(args.db_path, args.db_pool_size)
+    # Only reads the schema version when the database is already up to date
+    with db_pool.connection() as conn:
+        migrate(conn)
+
+    connection_limits = ConnectionLimits(args.idle_timeout, args.send_timeout, args.max_connections,
+                                         args.max_output_buffer)
+    client_connections = ConnectionRegistry()
+    active_sessions = SessionRegistry()
+    user_locks = UserLockManager(args.lock_stripes)
+    balance_cache = BalanceCache(args.cache_size, args.cache_ttl)
+    subscriptions = SubscriptionHub(announce_subscribers)
+
+    price_book = PriceBook()
+    if args.prices:
+        logger.info(f"Loaded {price_book.load_csv(args.prices)} prices from {args.prices}")
+    # Index the held symbols, then the listed ones so the price book's names win
+    symbol_index = SymbolIndex()
+    with db_pool.connection() as conn:
+        symbol_index.load(conn.cursor())
+    for listing in price_book.listings():
+        symbol_index.add(listing.symbol, listing.name)
+    logger.info(f"Indexed {len(symbol_index)} symbols for LOOKUP")
+
+    trade_writer = None
+    if args.group_commit:
+        trade_writer = GroupCommitWriter(db_pool, args.group_commit_batch, args.group_commit_delay_ms / 1000,
+                                         args.group_commit_synchronous)
+        trade_writer.start()
+    if args.snapshot_sessions:
+        background_threads.append(active_sessions.start_snapshots(db_pool, args.snapshot_sessions, background_stop))
+    if args.ledger_snapshot_interval and args.worker_index in (None, 0):
+        # One worker is enough to snapshot the shared database
+        background_threads.append(start_ledger_snapshots(db_pool, args.ledger_snapshot_interval, background_stop))
+    log_sample_rate = args.log_sample_rate
+    if args.stats_interval:
+        background_threads.append(server_metrics.start_dumps(args.stats_interval, background_stop))
+
+def serve(args, server_socket=None):
+    """
+    Serve clients in the selected mode until the server is stopped, then drain
+    the connections and flush pending trades. Call configure(args) first.
+    """
     try:
-        client_socket, client_address = server_socket.accept()
-        client_thread = threading.Thread(target=handle_client, args=(client_socket, client_address))
-        client_thread.start()
-        client_threads.append(client_thread)  # Add the thread to the client_threads list
-    except KeyboardInterrupt:
-        print("\n[*] Interrupted by user, initiating server shutdown.")
-        break
-    except socket.error:
-        if not is_server_running:
-            break  # Break if socket error occurs due to shutdown
-
-# Close server socket
-server_socket.close()
+        if args.mode == "async":
+            # Imported here so the threaded mode does not pay for asyncio
+            import async_server
+            async_server.run(args.host, args.port, run_command, register_client, cleanup_client, args.db_workers,
+                             async_stop, args.drain_timeout, SHUTDOWN_NOTICE, connection_limits, server_metrics,
+                             server_socket)
+        else:
+            run_threaded_server(args.host, args.port, server_socket)
+    finally:
+        stop_server()
+        if args.mode == "threaded":
+            # Let running commands finish, then tell the clients and disconnect them
+            logger.info(f"Draining {len(client_connections)} connections")
+            busy = client_connections.drain(time.monotonic() + args.drain_timeout, SHUTDOWN_NOTICE)
+            if busy:
+                logger.warning(f"{busy} connections were still running a command after {args.drain_timeout}s")
+        if trade_writer is not None:
+            # Flush queued trades before exiting
+            trade_writer.stop()
+            logger.info(f"Group commit statistics: {trade_writer.stats()}")
+        # Let a snapshot in progress finish before the pool is closed under it
+        background_stop.set()
+        for thread in background_threads:
+            thread.join()
+        # Closing the last connection checkpoints the WAL, so the next start needs no recovery
+        db_pool.close()
+        logger.info(f"Balance cache statistics: {balance_cache.stats()}")
+        logger.info(f"User lock statistics: {user_locks.stats()}")
+        logger.info("Server stopped")
+
+class Server:
+    """
+    A server running in this process on a background thread, for test
+    harnesses, benchmarks and embedding.
+
+    options is a list of further command line options. The command handlers
+    share this module's state, so only one Server can run at a time.
+
+        with Server(port=0, database_path="test.db", options=["--mode", "async"]) as server:
+            sock = socket.create_connection((server.host, server.port))
+    """
+
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, database_path=DATABASE_PATH, options=()):
+        self.args = build_parser().parse_args(["--host", host, "--port", str(port), "--db-path", database_path,
+                                               *options])
+        if self.args.workers > 1:
+            raise ValueError("--workers needs separate processes; run server.py instead")
+        self.host = host
+        self.port = port
+        self._thread = None
+
+    def start(self):
+        """
+        Set up the database and start serving; returns once clients can connect.
+        """
+        server_socket = open_listening_socket(self.host, self.port)
+        # With port 0 the OS picked a free port
+        self.port = server_socket.getsockname()[1]
+        try:
+            configure(self.args)
+        except BaseException:
+            server_socket.close()
+            raise
+        self._thread = threading.Thread(target=serve, args=(self.args, server_socket), name="server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """
+        Shut the server down gracefully and wait for it to finish.
+        """
+        stop_server()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+def main(argv=None):
+    """
+    Parse the command line and start the server in the selected mode.
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if args.workers > 1:
+        if args.mode != "threaded":
+            parser.error("--workers is only supported in threaded mode")
+        # Supervise the workers, which run this script again with --worker-index
+        run_supervisor(args.host, args.port, args.workers, os.path.abspath(__file__),
+                       sys.argv[1:] if argv is None else list(argv), shutdown_timeout=args.drain_timeout + 5)
+        return
+
+    global shard
+    configure(args)
+    server_socket = None
+    if args.worker_index is not None:
+        server_socket, shard = attach_worker(args.worker_index, args.listen_fd,
+                                             [int(fd) for fd in args.inbox_fds.split(",")])
+        shard.start(adopt_client, price_book.update, symbol_index.add, subscriptions.publish)
+
+    # SIGTERM (sent by the supervisor, or for a rolling restart) shuts down gracefully
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_server())
+
+    serve(args, server_socket)
+
+if __name__ == "__main__":
+    main()
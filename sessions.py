@@ -0,0 +1,94 @@
+# In-memory registry of logged in clients.
+#
+# Sessions only live as long as their connection, so they are kept in a dict
+# keyed by the client's (ip_address, port) instead of the ActiveUsers table.
+# LOGIN, LOGOUT, DEPOSIT and WHO therefore never touch the disk. For tools that
+# still read ActiveUsers, the registry can periodically copy itself into it.
+
+import logging
+import threading
+import time
+
+from db_pool import immediate_transaction
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    """
+    A logged in client connection.
+    """
+    __slots__ = ("user_id", "user_name", "ip_address", "port", "login_time")
+
+    def __init__(self, user_id, user_name, ip_address, port):
+        self.user_id = user_id
+        self.user_name = user_name
+        self.ip_address = ip_address
+        self.port = port
+        self.login_time = time.time()
+
+
+class SessionRegistry:
+    """
+    Lock-protected map from client address to Session.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def login(self, client_address, user_id, user_name):
+        """
+        Record that the client at client_address logged in as user_id.
+        """
+        session = Session(user_id, user_name, client_address[0], client_address[1])
+        with self._lock:
+            self._sessions[client_address] = session
+        return session
+
+    def logout(self, client_address):
+        """
+        Forget the session of the client at client_address, returning it if there was one.
+        """
+        with self._lock:
+            return self._sessions.pop(client_address, None)
+
+    def sessions(self):
+        """
+        Return a list of all current sessions.
+        """
+        with self._lock:
+            return list(self._sessions.values())
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def snapshot_to_table(self, conn):
+        """
+        Replace the contents of the ActiveUsers table with the current sessions.
+        """
+        rows = [(session.user_id, session.user_name, session.ip_address, session.port)
+                for session in self.sessions()]
+        with immediate_transaction(conn) as cursor:
+            cursor.execute("DELETE FROM ActiveUsers")
+            cursor.executemany("INSERT INTO ActiveUsers (user_id, user_name, ip_address, port) VALUES (?, ?, ?, ?)",
+                               rows)
+
+    def start_snapshots(self, pool, interval, stop):
+        """
+        Copy the sessions into ActiveUsers every interval seconds on a background
+        thread until the stop Event is set. Returns the thread.
+        """
+        def snapshot_loop():
+            while True:
+                try:
+                    with pool.connection() as conn:
+                        self.snapshot_to_table(conn)
+                except Exception as e:
+                    logger.warning(f"Session snapshot failed: {e}")
+                if stop.wait(interval):
+                    break
+
+        thread = threading.Thread(target=snapshot_loop, name="session-snapshots", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,198 @@
+# Push notifications of balance and holdings changes.
+#
+# A client that sends SUBSCRIBE is sent an update whenever a BUY, SELL, BATCH
+# or DEPOSIT of its user commits, or of any user for root, instead of polling
+# BALANCE and LIST. Updates are pushed as responses to the SUBSCRIBE request,
+# carrying its request ID, with one 'UPDATE <user_id> <USD|symbol> <balance>'
+# line per changed balance.
+#
+# Publishing a change only merges it into the pending changes of the matching
+# subscriptions and wakes their senders, so a trade never waits for a
+# subscriber's socket. Pending changes are keyed by user and symbol and keep
+# only the latest balance, so a subscriber that reads slowly gets fewer, merged
+# updates and its backlog never grows beyond one entry per balance it watches.
+#
+# How updates reach the socket is up to the connection: the threaded server
+# gives every subscription a sender thread (thread_sender), while the async
+# server writes them from a task on its event loop, so it still needs no thread
+# per connection. A subscriber is never reaped for being idle, since it may
+# only listen.
+
+import threading
+
+from money import format_shares, format_usd
+
+# Subscriptions watching every user are stored under this key
+ALL_USERS = None
+
+
+class Subscription:
+    """
+    One connection's subscription and its pending changes.
+
+    The connection's sender is woken through wake() whenever changes become
+    pending or the subscription is closed, and collects them with take_update().
+    """
+    __slots__ = ("client_address", "user_id", "pending", "lock", "closed", "wake")
+
+    def __init__(self, client_address, user_id):
+        self.client_address = client_address
+        # The watched user, or ALL_USERS
+        self.user_id = user_id
+        # (user_id, "USD" or symbol) -> latest balance in cents or micro-shares not yet sent
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.wake = None
+
+    def offer(self, user_id, changes):
+        """
+        Merge (key, balance) changes of user_id into the pending update and wake the sender.
+        """
+        with self.lock:
+            idle = not self.pending
+            for key, balance in changes:
+                self.pending[user_id, key] = balance
+        # The sender is already awake while earlier changes are still pending
+        if idle:
+            self.wake()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.wake()
+
+    def take_update(self):
+        """
+        Return the text of the pending update and clear it; "" if nothing is
+        pending, or None once the subscription is closed.
+        """
+        with self.lock:
+            if self.closed:
+                return None
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return ""
+        lines = ["200 OK"]
+        lines.extend(f"UPDATE {user_id} {key} {format_usd(balance) if key == 'USD' else format_shares(balance)}"
+                     for (user_id, key), balance in pending.items())
+        return "\n".join(lines) + "\n"
+
+
+def thread_sender(push):
+    """
+    Return a sender that delivers updates from a thread of its own through
+    push(text), which blocks until the text is sent and raises OSError if the
+    client is gone or too slow.
+
+    A sender is called with (subscription, on_closed) to start delivering, and
+    returns the subscription's wake function; on_closed(subscription) is
+    called once it stops.
+    """
+    def start(subscription, on_closed):
+        ready = threading.Event()
+
+        def run():
+            while True:
+                ready.wait()
+                ready.clear()
+                text = subscription.take_update()
+                if text is None:
+                    break
+                if text:
+                    try:
+                        push(text)
+                    except OSError:
+                        break
+            on_closed(subscription)
+
+        threading.Thread(target=run, name="subscription", daemon=True).start()
+        return ready.set
+
+    return start
+
+
+class SubscriptionHub:
+    """
+    Thread-safe registry of the subscriptions, indexed by watched user.
+    """
+
+    def __init__(self, on_active=None):
+        self._by_user = {}
+        self._by_address = {}
+        self._lock = threading.Lock()
+        self.published = 0
+        # Called with True when the first subscription is added and False when
+        # the last one is removed, with the registry locked so calls stay in order
+        self.on_active = on_active
+
+    def __len__(self):
+        return len(self._by_address)
+
+    def is_subscribed(self, client_address):
+        return client_address in self._by_address
+
+    def subscribe(self, client_address, user_id, sender):
+        """
+        Start sending updates about user_id (ALL_USERS for every user) to a
+        connection through sender, replacing its previous subscription.
+        """
+        self.unsubscribe(client_address)
+        subscription = Subscription(client_address, user_id)
+        subscription.wake = sender(subscription, self._remove)
+        with self._lock:
+            self._by_address[client_address] = subscription
+            self._by_user.setdefault(user_id, set()).add(subscription)
+            if len(self._by_address) == 1 and self.on_active is not None:
+                self.on_active(True)
+        return subscription
+
+    def unsubscribe(self, client_address):
+        """
+        Stop the subscription of a connection. Returns False if it had none.
+        """
+        with self._lock:
+            subscription = self._by_address.get(client_address)
+        if subscription is None:
+            return False
+        self._remove(subscription)
+        return True
+
+    def publish(self, user_id, changes):
+        """
+        Queue (key, balance) changes of user_id for every subscription watching it.
+
+        key is "USD" for the cash balance in cents or a stock symbol for a
+        holding in micro-shares.
+        """
+        if not self._by_address:
+            return
+        with self._lock:
+            subscriptions = list(self._by_user.get(user_id, ())) + list(self._by_user.get(ALL_USERS, ()))
+            self.published += 1
+        for subscription in subscriptions:
+            subscription.offer(user_id, changes)
+
+    def stats(self):
+        """
+        Return the number of subscriptions and of changes published to them.
+        """
+        with self._lock:
+            return {"subscriptions": len(self._by_address), "published": self.published}
+
+    def _remove(self, subscription):
+        """
+        Forget a subscription that was closed or whose client went away.
+        """
+        with self._lock:
+            if self._by_address.get(subscription.client_address) is subscription:
+                del self._by_address[subscription.client_address]
+                watchers = self._by_user[subscription.user_id]
+                watchers.discard(subscription)
+                if not watchers:
+                    del self._by_user[subscription.user_id]
+                if not self._by_address and self.on_active is not None:
+                    self.on_active(False)
+        subscription.close()
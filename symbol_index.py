@@ -0,0 +1,111 @@
+# In-memory substring index of the stock symbols and names, used by LOOKUP.
+#
+# LOOKUP used to match '%text%' with LIKE against every holding, which no index
+# can serve. The number of distinct symbols is small even when Stocks holds
+# millions of rows, so the server keeps every symbol and its company name in
+# memory, indexed by all of their substrings of up to three characters. A
+# search of up to three characters is a single dict lookup; a longer one
+# intersects the sets of its trigrams and checks the few candidates left. The
+# matching symbols are then looked up in Stocks through idx_stocks_symbol.
+#
+# The index is loaded from Stocks at startup and is given every listed symbol
+# and every symbol bought afterwards, so it never misses a holding.
+
+import sys
+import threading
+import timeit
+
+# Longest substrings indexed; longer searches are answered from these
+GRAM_LENGTH = 3
+
+
+class SymbolIndex:
+    """
+    Thread-safe case-insensitive substring search over symbols and names.
+    """
+
+    def __init__(self):
+        # symbol -> company name, for every known symbol
+        self._names = {}
+        # substring of up to GRAM_LENGTH upper-case characters -> symbols containing it
+        self._grams = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def load(self, cursor):
+        """
+        Add every symbol held in the Stocks table. Returns the number of symbols added.
+        """
+        cursor.execute("SELECT stock_symbol, max(stock_name) FROM Stocks GROUP BY stock_symbol")
+        return sum(self.add(symbol, name) for symbol, name in cursor.fetchall())
+
+    def add(self, symbol, name=""):
+        """
+        Index symbol under its company name.
+
+        A symbol already known is only re-indexed if it gets a new, non-empty
+        name. Returns True if the index changed.
+        """
+        name = name or ""
+        current = self._names.get(symbol)
+        if current is not None and (not name or name == current):
+            return False
+        with self._lock:
+            current = self._names.get(symbol)
+            if current is not None:
+                if not name or name == current:
+                    return False
+                # Forget the substrings of the old name that the new one does not share
+                for gram in _grams(current) - _grams(symbol) - _grams(name):
+                    matches = self._grams.get(gram)
+                    matches.discard(symbol)
+                    if not matches:
+                        del self._grams[gram]
+            self._names[symbol] = name
+            for gram in _grams(symbol) | _grams(name):
+                self._grams.setdefault(gram, set()).add(symbol)
+        return True
+
+    def search(self, text):
+        """
+        Return the sorted symbols whose symbol or name contains text, ignoring case.
+        """
+        text = text.upper()
+        with self._lock:
+            if len(text) <= GRAM_LENGTH:
+                return sorted(self._grams.get(text, ()))
+            # Start from the rarest trigram so the intersection stays small
+            candidates = None
+            for gram in sorted(_grams(text, only=GRAM_LENGTH), key=lambda gram: len(self._grams.get(gram, ()))):
+                matches = self._grams.get(gram)
+                if not matches:
+                    return []
+                candidates = set(matches) if candidates is None else candidates & matches
+                if not candidates:
+                    return []
+            return sorted(symbol for symbol in candidates
+                          if text in symbol.upper() or text in self._names[symbol].upper())
+
+
+def _grams(text, only=None):
+    """
+    Return the set of upper-case substrings of text of up to GRAM_LENGTH characters,
+    or of exactly `only` characters.
+    """
+    text = text.upper()
+    lengths = (only,) if only else range(1, GRAM_LENGTH + 1)
+    return {text[start:start + length] for length in lengths for start in range(len(text) - length + 1)}
+
+
+# Microbenchmark of searches over a synthetic set of symbols
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    index = SymbolIndex()
+    for number in range(count):
+        index.add(f"S{number:05d}", f"Company {number} Holdings Inc")
+    for text in ("S1", "S12345", "hold", "Company 19999", "nothing"):
+        iterations = 200
+        seconds = timeit.timeit(lambda: index.search(text), number=iterations)
+        print(f"{text:<16} {len(index.search(text)):6d} matches {seconds / iterations * 1e6:10.1f} us per search")
@@ -0,0 +1,131 @@
+# Tests of SUBSCRIBE pushes against an in-process server, in both server modes.
+#
+#     python -m pytest test_subscriptions.py    # or: python -m unittest test_subscriptions
+
+import os
+import socket
+import tempfile
+import time
+import unittest
+
+import server
+from protocol import UNKNOWN_REQUEST_ID, encode_request, read_response
+
+# Seconds a test client waits for any response
+CLIENT_TIMEOUT = 10.0
+
+
+class SubscriptionTests:
+    """
+    Tests run against the server mode named by the TestCase they are mixed into.
+    """
+    mode = None
+
+    def start_server(self, *options):
+        """
+        Start a server on a fresh database in a temporary directory, stopped after the test.
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        running = server.Server("127.0.0.1", 0, os.path.join(directory.name, "test.db"),
+                                options=["--mode", self.mode, "--ledger-snapshot-interval", "0", *options])
+        running.start()
+        self.addCleanup(running.stop)
+        return running
+
+    def connect(self, running, login=True, receive_buffer=None):
+        """
+        Open a connection to running, logged in as Root (user 2) unless login is False.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if receive_buffer is not None:
+            # Must be set before connecting to limit the advertised window
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        sock.settimeout(CLIENT_TIMEOUT)
+        sock.connect(("127.0.0.1", running.port))
+        self.addCleanup(sock.close)
+        reader = sock.makefile("rb")
+        self.addCleanup(reader.close)
+        if login:
+            self.assertEqual(self.request(sock, reader, 1, "LOGIN Root Root01"), "200 OK")
+        return sock, reader
+
+    def request(self, sock, reader, request_id, command):
+        """
+        Send command and return the text of its response.
+        """
+        sock.sendall(encode_request(request_id, command))
+        response_id, response = read_response(reader)
+        self.assertEqual(response_id, request_id)
+        return response
+
+    def test_idle_subscriber_is_kept(self):
+        running = self.start_server("--idle-timeout", "0.5")
+        subscriber, updates = self.connect(running)
+        self.assertTrue(self.request(subscriber, updates, 2, "SUBSCRIBE").startswith("200 OK"))
+        idle, idle_reader = self.connect(running)
+
+        # Stay silent well past the idle timeout
+        time.sleep(1.5)
+
+        # The connection that is not subscribed was reaped
+        self.assertEqual(read_response(idle_reader)[0], UNKNOWN_REQUEST_ID)
+        self.assertIsNone(read_response(idle_reader))
+
+        # The subscriber still gets the next change, as a response to its SUBSCRIBE
+        trader, responses = self.connect(running)
+        self.assertTrue(self.request(trader, responses, 2, "DEPOSIT 5").startswith("200 OK"))
+        request_id, update = read_response(updates)
+        self.assertEqual(request_id, 2)
+        self.assertIn("UPDATE 2 USD 1000005.00", update)
+
+    def test_subscriber_that_stops_reading_is_dropped(self):
+        send_timeout = 1.0
+        running = self.start_server("--send-timeout", str(send_timeout), "--max-output-buffer", "16384",
+                                    "--prices", "")
+        # Subscribe, then never read again
+        subscriber, updates = self.connect(running, receive_buffer=4096)
+        self.assertTrue(self.request(subscriber, updates, 2, "SUBSCRIBE").startswith("200 OK"))
+
+        # Every batch changes 500 holdings, so each push is tens of kilobytes
+        trader, responses = self.connect(running)
+        legs = " ".join(f"BUY S{index:03d}{'X' * 36} 0.01 1" for index in range(500))
+        deadline = time.monotonic() + 30
+        slowest = 0.0
+        request_id = 1
+        while not server.server_metrics.counter("slow_clients_dropped") and time.monotonic() < deadline:
+            request_id += 1
+            started = time.monotonic()
+            self.assertTrue(self.request(trader, responses, request_id, f"BATCH 2 {legs}").startswith("200 OK"))
+            slowest = max(slowest, time.monotonic() - started)
+
+        # The subscriber was dropped, and trades never waited for its socket
+        self.assertEqual(server.server_metrics.counter("slow_clients_dropped"), 1)
+        self.assertLess(slowest, send_timeout)
+        deadline = time.monotonic() + CLIENT_TIMEOUT
+        while server.subscriptions.stats()["subscriptions"] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(server.subscriptions.stats()["subscriptions"], 0)
+
+        # Its connection was closed or reset, possibly after the data already delivered;
+        # a connection left open would time out here
+        try:
+            while subscriber.recv(65536):
+                pass
+        except ConnectionResetError:
+            pass
+
+        # The trader's connection is unaffected
+        self.assertTrue(self.request(trader, responses, request_id + 1, "DEPOSIT 5").startswith("200 OK"))
+
+
+class ThreadedSubscriptionTests(SubscriptionTests, unittest.TestCase):
+    mode = "threaded"
+
+
+class AsyncSubscriptionTests(SubscriptionTests, unittest.TestCase):
+    mode = "async"
+
+
+if __name__ == "__main__":
+    unittest.main()
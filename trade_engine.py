@@ -0,0 +1,228 @@
+# Trade execution shared by the BUY, SELL and DEPOSIT handlers.
+#
+# Every order is applied with conditional UPDATEs and an UPSERT, so the balance
+# checks and the writes happen in the same statement and cannot race with
+# another thread. The apply_* functions only issue statements and expect to run
+# inside a transaction opened by the caller; execute() wraps one of them in its
+# own BEGIN IMMEDIATE transaction.
+#
+# Balances, amounts and prices are integers in the units of money.py: cents
+# and micro-shares. The value of an order is rounded to the cent once, and
+# that value is what is charged or credited and recorded in the ledger. Orders
+# worth more than money.MAX_UNITS are rejected before any statement runs, and
+# the conditional UPDATEs also refuse to take a balance or holding past
+# money.MAX_BALANCE, so every value stays a 64-bit INTEGER in SQLite.
+#
+# Every applied order is also appended to the ledger in the same transaction.
+
+import json
+
+import ledger
+from db_pool import immediate_transaction
+from money import MAX_BALANCE, MAX_UNITS, format_usd, order_value
+
+# Whether orders are appended to the ledger; only turned off to measure its cost
+write_ledger = True
+
+
+class TradeRejected(Exception):
+    """
+    Raised when an order cannot be applied. The message is the response to send.
+    """
+
+
+class LegRejected(TradeRejected):
+    """
+    Raised when one leg of a batch cannot be applied; leg is its index in the batch.
+    """
+
+    def __init__(self, leg, message):
+        super().__init__(message)
+        self.leg = leg
+
+
+def _order_total(stock_amount, stock_price):
+    """
+    Return the value in cents of stock_amount micro-shares at stock_price cents.
+
+    Raises TradeRejected if the order is worth nothing or more than MAX_UNITS.
+    """
+    total = order_value(stock_amount, stock_price)
+    if stock_amount <= 0 or stock_price <= 0 or total <= 0:
+        raise TradeRejected("400 invalid command, invalid arguments")
+    if total > MAX_UNITS:
+        raise TradeRejected(f"400 order value out of range, at most ${format_usd(MAX_UNITS)}")
+    return total
+
+
+def apply_buy(cursor, user_id, ticker, stock_amount, stock_price, stock_name=""):
+    """
+    Buy stock_amount micro-shares of ticker for user_id at stock_price cents.
+
+    stock_name, if given, is recorded as the name of the holding.
+
+    Returns a tuple of (new stock balance, new USD balance).
+    """
+    total_cost = _order_total(stock_amount, stock_price)
+
+    # Deduct the total cost only if the user can afford it
+    cursor.execute("UPDATE Users SET usd_balance = usd_balance - ? WHERE ID = ? AND usd_balance >= ? "
+                   "RETURNING usd_balance", (total_cost, user_id, total_cost))
+    row = cursor.fetchone()
+    if row is None:
+        # Tell a missing user apart from a short balance
+        cursor.execute("SELECT 1 FROM Users WHERE ID = ?", (user_id,))
+        if cursor.fetchone() is None:
+            raise TradeRejected(f"400 user {user_id} not found.")
+        raise TradeRejected("400 insufficient funds")
+    new_balance = row[0]
+
+    # Insert the holding or add to the existing one, keeping its name unless a new one is known.
+    # A holding that would go past MAX_BALANCE is left alone and the order rejected.
+    cursor.execute("INSERT INTO Stocks (stock_symbol, stock_name, stock_balance, user_id) VALUES (?, ?, ?, ?) "
+                   "ON CONFLICT (user_id, stock_symbol) DO UPDATE SET stock_balance = stock_balance + excluded.stock_balance, "
+                   "stock_name = coalesce(nullif(excluded.stock_name, ''), stock_name) WHERE stock_balance <= ? "
+                   "RETURNING stock_balance", (ticker, stock_name, stock_amount, user_id, MAX_BALANCE - stock_amount))
+    row = cursor.fetchone()
+    if row is None:
+        raise TradeRejected(f"400 stock balance out of range for {ticker}")
+    updated_stock_balance = row[0]
+
+    if write_ledger:
+        ledger.record(cursor, "BUY", user_id, ticker, stock_amount, stock_price, -total_cost)
+    return updated_stock_balance, new_balance
+
+
+def apply_sell(cursor, user_id, ticker, stock_amount, stock_price):
+    """
+    Sell stock_amount micro-shares of ticker for user_id at stock_price cents.
+
+    Returns a tuple of (new stock balance, new USD balance).
+    """
+    total_amount = _order_total(stock_amount, stock_price)
+
+    # Take the shares only if the user holds enough of them
+    cursor.execute("UPDATE Stocks SET stock_balance = stock_balance - ? "
+                   "WHERE user_id = ? AND stock_symbol = ? AND stock_balance >= ? "
+                   "RETURNING stock_balance", (stock_amount, user_id, ticker, stock_amount))
+    row = cursor.fetchone()
+    if row is None:
+        # Tell a missing user apart from a short holding
+        cursor.execute("SELECT 1 FROM Users WHERE ID = ?", (user_id,))
+        if cursor.fetchone() is None:
+            raise TradeRejected(f"400 User {user_id} not found.")
+        raise TradeRejected(f"400 insufficient stock balance for {ticker}")
+    updated_stock_balance = row[0]
+
+    # Credit the proceeds, unless that would take the balance past MAX_BALANCE
+    cursor.execute("UPDATE Users SET usd_balance = usd_balance + ? WHERE ID = ? AND usd_balance <= ? "
+                   "RETURNING usd_balance", (total_amount, user_id, MAX_BALANCE - total_amount))
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute("SELECT 1 FROM Users WHERE ID = ?", (user_id,))
+        if cursor.fetchone() is None:
+            raise TradeRejected(f"400 User {user_id} not found.")
+        raise TradeRejected("400 USD balance out of range")
+
+    if write_ledger:
+        ledger.record(cursor, "SELL", user_id, ticker, -stock_amount, stock_price, total_amount)
+    return updated_stock_balance, row[0]
+
+
+def apply_deposit(cursor, user_id, amount):
+    """
+    Add amount cents to the USD balance of user_id.
+
+    Returns the new USD balance.
+    """
+    if amount <= 0 or amount > MAX_UNITS:
+        raise TradeRejected("400 invalid command, invalid arguments")
+    # Add the amount unless that would take the balance past MAX_BALANCE
+    cursor.execute("UPDATE Users SET usd_balance = usd_balance + ? WHERE ID = ? AND usd_balance <= ? "
+                   "RETURNING usd_balance", (amount, user_id, MAX_BALANCE - amount))
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute("SELECT 1 FROM Users WHERE ID = ?", (user_id,))
+        if cursor.fetchone() is None:
+            raise TradeRejected(f"400 user {user_id} not found.")
+        raise TradeRejected("400 USD balance out of range")
+    if write_ledger:
+        ledger.record(cursor, "DEPOSIT", user_id, None, None, None, amount)
+    return row[0]
+
+
+def apply_batch(cursor, user_id, legs):
+    """
+    Apply several buy and sell legs for user_id as one order.
+
+    legs is a list of (side, ticker, stock_amount, stock_price, stock_name)
+    tuples, with side "BUY" or "SELL" and the amount and price in micro-shares
+    and cents. All legs are first checked in order
+    against the user's balance and holdings, so a sell can pay for a later buy,
+    and then written with one statement per table. If a leg fails nothing is
+    written and LegRejected is raised for it.
+
+    Returns a tuple of (new stock balance after each leg, new USD balance).
+    """
+    cursor.execute("SELECT usd_balance FROM Users WHERE ID = ?", (user_id,))
+    row = cursor.fetchone()
+    if row is None:
+        raise TradeRejected(f"400 user {user_id} not found.")
+    balance = row[0]
+    cursor.execute("SELECT stock_symbol, stock_balance FROM Stocks "
+                   "WHERE user_id = ? AND stock_symbol IN (SELECT value FROM json_each(?))",
+                   (user_id, json.dumps(sorted({leg[1] for leg in legs}))))
+    holdings = dict(cursor.fetchall())
+
+    # Check every leg against the running balances before writing anything
+    cash_change = 0
+    stock_changes = {}
+    stock_names = {}
+    leg_balances = []
+    entries = []
+    for index, (side, ticker, stock_amount, stock_price, stock_name) in enumerate(legs):
+        try:
+            total = _order_total(stock_amount, stock_price)
+        except TradeRejected as e:
+            raise LegRejected(index, str(e)) from None
+        if side == "BUY":
+            if balance + cash_change < total:
+                raise LegRejected(index, "400 insufficient funds")
+            if holdings.get(ticker, 0) + stock_amount > MAX_BALANCE:
+                raise LegRejected(index, f"400 stock balance out of range for {ticker}")
+            cash_change -= total
+            holdings[ticker] = holdings.get(ticker, 0) + stock_amount
+            stock_changes[ticker] = stock_changes.get(ticker, 0) + stock_amount
+            entries.append((side, user_id, ticker, stock_amount, stock_price, -total))
+        else:
+            if holdings.get(ticker, 0) < stock_amount:
+                raise LegRejected(index, f"400 insufficient stock balance for {ticker}")
+            if balance + cash_change + total > MAX_BALANCE:
+                raise LegRejected(index, "400 USD balance out of range")
+            cash_change += total
+            holdings[ticker] -= stock_amount
+            stock_changes[ticker] = stock_changes.get(ticker, 0) - stock_amount
+            entries.append((side, user_id, ticker, -stock_amount, stock_price, total))
+        if stock_name:
+            stock_names[ticker] = stock_name
+        leg_balances.append(holdings[ticker])
+
+    # Apply the net change of every symbol and of the cash balance
+    cursor.executemany("INSERT INTO Stocks (stock_symbol, stock_name, stock_balance, user_id) VALUES (?, ?, ?, ?) "
+                       "ON CONFLICT (user_id, stock_symbol) DO UPDATE SET stock_balance = stock_balance + excluded.stock_balance, "
+                       "stock_name = coalesce(nullif(excluded.stock_name, ''), stock_name)",
+                       [(ticker, stock_names.get(ticker, ""), change, user_id) for ticker, change in stock_changes.items()])
+    cursor.execute("UPDATE Users SET usd_balance = usd_balance + ? WHERE ID = ? RETURNING usd_balance",
+                   (cash_change, user_id))
+    new_balance = cursor.fetchone()[0]
+    if write_ledger:
+        ledger.record_many(cursor, entries)
+    return leg_balances, new_balance
+
+
+def execute(conn, operation, *args):
+    """
+    Run one of the apply_* functions in its own transaction and return its result.
+    """
+    with immediate_transaction(conn) as cursor:
+        return operation(cursor, *args)
@@ -0,0 +1,95 @@
+# Per-user serialization of trades and deposits.
+#
+# SQLite already applies each order atomically, but orders for the same user
+# sent over several connections could still be applied in any order, and the
+# cached balance checks made before a trade could see another order of the same
+# user half done. Handlers therefore hold the user's lock from the pre-check
+# until the cache is invalidated.
+#
+# Users are hashed onto a fixed number of stripes, so memory does not grow with
+# the number of users and independent users almost never share a lock. Each
+# stripe is a ticket lock: waiters are served in the order they arrived, so a
+# user's orders are applied in the order the server received them.
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Default number of locks users are spread over
+DEFAULT_STRIPES = 1024
+
+
+class _Stripe:
+    """
+    A FIFO ticket lock with contention counters.
+    """
+    __slots__ = ("condition", "next_ticket", "now_serving", "acquisitions", "contended", "wait_time", "max_wait")
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.next_ticket = 0
+        self.now_serving = 0
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+
+class UserLockManager:
+    """
+    Striped per-user locks for serializing one user's orders.
+    """
+
+    def __init__(self, stripes=DEFAULT_STRIPES):
+        self._stripes = [_Stripe() for _ in range(stripes)]
+
+    @contextmanager
+    def lock(self, user_id):
+        """
+        Hold the lock of user_id, waiting behind orders of the same user that arrived earlier.
+        """
+        stripe = self._stripes[user_id % len(self._stripes)]
+        with stripe.condition:
+            ticket = stripe.next_ticket
+            stripe.next_ticket += 1
+            stripe.acquisitions += 1
+            if stripe.now_serving != ticket:
+                stripe.contended += 1
+                started = time.perf_counter()
+                while stripe.now_serving != ticket:
+                    stripe.condition.wait()
+                waited = time.perf_counter() - started
+                stripe.wait_time += waited
+                stripe.max_wait = max(stripe.max_wait, waited)
+        try:
+            yield
+        finally:
+            with stripe.condition:
+                stripe.now_serving += 1
+                stripe.condition.notify_all()
+
+    def stats(self, hottest=5):
+        """
+        Return the contention counters, summed over all stripes, and the most contended stripes.
+        """
+        acquisitions = contended = 0
+        wait_time = max_wait = 0.0
+        hot = []
+        for index, stripe in enumerate(self._stripes):
+            with stripe.condition:
+                acquisitions += stripe.acquisitions
+                contended += stripe.contended
+                wait_time += stripe.wait_time
+                max_wait = max(max_wait, stripe.max_wait)
+                if stripe.contended:
+                    hot.append((stripe.contended, index))
+        hot.sort(reverse=True)
+        return {
+            "acquisitions": acquisitions,
+            "contended": contended,
+            "contention_rate": contended / acquisitions if acquisitions else 0.0,
+            "total_wait_ms": wait_time * 1000,
+            "average_wait_ms": wait_time * 1000 / contended if contended else 0.0,
+            "max_wait_ms": max_wait * 1000,
+            "hottest_stripes": {index: count for count, index in hot[:hottest]},
+        }
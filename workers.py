@@ -0,0 +1,268 @@
+# Multi-process mode of the server.
+#
+# A single Python process can only use one core for the command handlers, so
+# with --workers K the server runs as a supervisor and K worker processes. The
+# supervisor binds the listening socket and passes it to every worker, and the
+# kernel hands each new connection to whichever worker accepts it first.
+#
+# Users are sharded over the workers by user_id % K. When a client logs in on
+# a worker that does not own its user, the worker passes the client socket,
+# together with any request bytes it has already buffered, to the owner over a
+# Unix datagram socket. All commands of a user therefore run in one process, so
+# its balance cache stays coherent and its orders are applied in the order sent.
+# A BUY or SELL naming a user served by another worker is therefore rejected
+# rather than applied outside that worker's per-user lock. Prices set with PRICE
+# and newly bought symbols are sent to every other worker.
+# Balance changes are sent to the workers that have SUBSCRIBE clients, which
+# every worker announces when its first one arrives and its last one leaves.
+#
+# Shutdown is coordinated by the supervisor: SHUTDOWN, SIGINT or SIGTERM make
+# it send SIGTERM to every worker, wait for them to drain their connections,
+# flush and exit, and kill any that do not exit within the shutdown timeout.
+
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+# Default seconds the supervisor waits for workers to exit before killing them
+SHUTDOWN_TIMEOUT = 15.0
+
+# Largest handoff message, enough for a message plus a full read buffer
+MAX_MESSAGE = 256 * 1024
+
+# Seconds to wait before restarting a worker that died, so a crash loop does not spin
+RESTART_DELAY = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class PrefixedReader:
+    """
+    Line reader that returns bytes buffered by a previous worker before reading the socket.
+    """
+
+    def __init__(self, prefix, reader):
+        self.prefix = prefix
+        self.reader = reader
+
+    def readline(self, limit=-1):
+        if self.prefix:
+            newline = self.prefix.find(b"\n", 0, limit if limit > 0 else None)
+            if newline >= 0:
+                line, self.prefix = self.prefix[:newline + 1], self.prefix[newline + 1:]
+                return line
+            line, self.prefix = self.prefix, b""
+            if limit > 0 and len(line) >= limit:
+                return line
+            return line + self.reader.readline(limit - len(line) if limit > 0 else -1)
+        return self.reader.readline(limit)
+
+    def close(self):
+        self.reader.close()
+
+
+def buffered_bytes(client_socket, reader):
+    """
+    Return the bytes reader has already taken from client_socket without blocking.
+    """
+    client_socket.setblocking(False)
+    try:
+        return reader.peek()
+    except BlockingIOError:
+        return b""
+    finally:
+        client_socket.setblocking(True)
+
+
+class Shard:
+    """
+    This worker's place among the workers, and the channels to the other ones.
+    """
+
+    def __init__(self, index, inboxes):
+        self.index = index
+        self.count = len(inboxes)
+        # One datagram socket per worker; every worker can send to all of them
+        self.inboxes = inboxes
+        # Indexes of the other workers that currently have subscriptions
+        self.watchers = set()
+
+    def owner(self, user_id):
+        """
+        Return the index of the worker that serves user_id.
+        """
+        return user_id % self.count
+
+    def owns(self, user_id):
+        return self.owner(user_id) == self.index
+
+    def hand_off(self, client_socket, client_address, user_id, user_name, buffered):
+        """
+        Pass a logged in client to the worker that owns its user.
+        """
+        message = json.dumps({
+            "type": "client",
+            "address": list(client_address),
+            "user_id": user_id,
+            "user_name": user_name,
+            # latin-1 maps every byte to one character, so the bytes survive JSON
+            "buffered": buffered.decode("latin-1"),
+        }).encode()
+        socket.send_fds(self.inboxes[self.owner(user_id)], [message], [client_socket.fileno()])
+
+    def notify_price(self, symbol, price, name):
+        """
+        Tell every other worker about a price set with the PRICE command.
+        """
+        self._broadcast({"type": "price", "symbol": symbol, "price": price, "name": name})
+
+    def notify_symbol(self, symbol, name):
+        """
+        Tell every other worker about a symbol held for the first time, for their symbol index.
+        """
+        self._broadcast({"type": "symbol", "symbol": symbol, "name": name})
+
+    def notify_watching(self, active):
+        """
+        Tell every other worker whether this one has subscriptions to feed.
+        """
+        self._broadcast({"type": "watch", "index": self.index, "active": active})
+
+    def notify_change(self, user_id, changes):
+        """
+        Send committed (key, balance) changes of user_id to the workers with subscriptions.
+        """
+        if self.watchers:
+            message = json.dumps({"type": "change", "user_id": user_id, "changes": changes}).encode()
+            for index in list(self.watchers):
+                self.inboxes[index].send(message)
+
+    def _broadcast(self, message):
+        """
+        Send a message to every worker but this one.
+        """
+        message = json.dumps(message).encode()
+        for index, inbox in enumerate(self.inboxes):
+            if index != self.index:
+                inbox.send(message)
+
+    def start(self, on_client, on_price, on_symbol, on_change):
+        """
+        Receive handoffs, prices, symbols and balance changes for this worker on a background thread.
+
+        on_client(client_socket, client_address, user_id, user_name, buffered) is
+        called on a new thread for every client handed over.
+        """
+        def receive_loop():
+            inbox = self.inboxes[self.index]
+            while True:
+                message, fds, _, _ = socket.recv_fds(inbox, MAX_MESSAGE, 1)
+                message = json.loads(message)
+                if message["type"] == "price":
+                    on_price(message["symbol"], message["price"], message["name"])
+                elif message["type"] == "symbol":
+                    on_symbol(message["symbol"], message["name"])
+                elif message["type"] == "change":
+                    on_change(message["user_id"], [tuple(change) for change in message["changes"]])
+                elif message["type"] == "watch":
+                    if message["active"]:
+                        self.watchers.add(message["index"])
+                    else:
+                        self.watchers.discard(message["index"])
+                elif fds:
+                    client_socket = socket.socket(fileno=fds[0])
+                    threading.Thread(target=on_client, daemon=True,
+                                     args=(client_socket, tuple(message["address"]), message["user_id"],
+                                           message["user_name"], message["buffered"].encode("latin-1"))).start()
+
+        threading.Thread(target=receive_loop, name="shard-inbox", daemon=True).start()
+
+    def request_shutdown(self):
+        """
+        Ask the supervisor to stop all workers.
+        """
+        os.kill(os.getppid(), signal.SIGTERM)
+
+
+def worker_arguments(index, listen_fd, inbox_fds):
+    """
+    Return the extra command line arguments that start server.py as worker index.
+    """
+    return ["--workers", "1", "--worker-index", str(index), "--listen-fd", str(listen_fd),
+            "--inbox-fds", ",".join(str(fd) for fd in inbox_fds)]
+
+
+def attach_worker(index, listen_fd, inbox_fds):
+    """
+    Rebuild the listening socket and the Shard from the descriptors a worker inherited.
+    """
+    server_socket = socket.socket(fileno=listen_fd)
+    inboxes = [socket.socket(fileno=fd) for fd in inbox_fds]
+    return server_socket, Shard(index, inboxes)
+
+
+def run_supervisor(host, port, workers, server_script, server_args, shutdown_timeout=SHUTDOWN_TIMEOUT):
+    """
+    Bind host:port, run `workers` copies of server_script on it and restart any that die.
+
+    Returns once every worker has exited after a shutdown was requested.
+    """
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind((host, port))
+    server_socket.listen(1024)
+
+    inboxes = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(workers)]
+
+    def spawn(index):
+        # A worker receives on the first socket of its own pair and sends through the second one of the others
+        fds = [inboxes[other][0 if other == index else 1].fileno() for other in range(workers)]
+        command = [sys.executable, server_script] + server_args + worker_arguments(index, server_socket.fileno(), fds)
+        return subprocess.Popen(command, pass_fds=[server_socket.fileno()] + fds)
+
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        if stopping.is_set():
+            return
+        stopping.set()
+        logger.info(f"Supervisor stopping {workers} workers")
+        for process in processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+
+    processes = {}
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(workers):
+        processes[index] = spawn(index)
+    logger.info(f"Supervisor listening on {host}:{port} with {workers} workers")
+
+    deadline = None
+    while processes:
+        if stopping.is_set() and deadline is None:
+            deadline = time.monotonic() + shutdown_timeout
+        for index, process in list(processes.items()):
+            if process.poll() is None:
+                if deadline is not None and time.monotonic() > deadline:
+                    logger.warning(f"Worker {index} did not stop in time, killing it")
+                    process.kill()
+                continue
+            del processes[index]
+            if not stopping.is_set():
+                logger.warning(f"Worker {index} exited with status {process.returncode}, restarting it")
+                time.sleep(RESTART_DELAY)
+                processes[index] = spawn(index)
+        time.sleep(0.1)
+
+    server_socket.close()
+    for pair in inboxes:
+        pair[0].close()
+        pair[1].close()
+    logger.info("All workers stopped")